@@ -1,16 +1,33 @@
 from bot_config import validate_env_variables
-from gh_oauth_token import get_token, store_token
-from webhook_handlers import check_conversation_resolution, check_trunk_status, \
-    pr_template_check,  run_conversation_check_scan_for_prs
+from check_publisher import flush as flush_checks, publisher_stats
+from etag_cache import cache_stats
+from gh_oauth_token import get_private_key, get_token, store_token
+from gh_session import rate_limit_status
+from debouncer import debounce, debounce_stats, run_pending
+from event_router import DEBOUNCED_POLICIES, RERUN_EVENTS, SHA_DETERMINED_EVENTS, route
+from idempotency import claim_delivery, claim_result, idempotency_stats, release_delivery, release_result
+from job_journal import complete as complete_job, flush as flush_journal, journal_stats, record as record_job, \
+    release as release_jobs, start as start_journal
+from policies import POLICIES
+from policy_engine import enabled as enabled_policies, engine_stats
+from priority import BACKGROUND, INTERACTIVE, RERUN
+from webhook_handlers import run_conversation_check_scan_for_prs, run_policies
+from webhook_intake import is_wanted, verify_signature
+from work_queue import join as join_queue, queue_stats, submit
 
+import json_decode
 import logging
+import metrics
+import os
 import sys
+import time
 import datetime
 import traceback
 import markdown2
 
-from flask import Flask, request, redirect, render_template
-from objectify_json import ObjectifyJSON
+from flask import Flask, jsonify, request, redirect, render_template
+from payload_views import WebhookView
+from pr_context import PullRequestContext, commits_cache_stats
 
 log = logging.getLogger(__name__)
 
@@ -71,42 +88,247 @@ def process_message():
     - Is your webhook forwarding tool (i.e., pysmee or smee-client) running?
     - Is github SENDING webhooks to the same https://smee.io URL you're RECEIVING from?
 
+    The delivery is only validated (and journaled) here; the handlers run later on
+    the work queue so GitHub gets its response right away. Deliveries no handler
+    is interested in, with a bad signature, or that GitHub sends again are dropped,
+    the first two before their payload is decoded.
     """
-    webhook = ObjectifyJSON(request.json)
-    event_type = request.headers['X-Github-Event']
+    event_type = request.headers.get('X-Github-Event')
+    delivery_id = request.headers.get('X-GitHub-Delivery')
+    body = request.get_data(cache=False)
 
-    # TODO: clean up here
-    if event_type == 'pull_request' and str(webhook.action).lower() in ['synchronize', 'opened']:
-        check_trunk_status(webhook)
-    if event_type == 'pull_request' and str(webhook.action).lower() in ['opened', 'edited', 'synchronize']:
-        pr_template_check(webhook)
-    if event_type == 'pull_request' and str(webhook.action).lower() in ['synchronize', 'opened']:
-        check_conversation_resolution(webhook)
+    if not event_type:
+        return 'BAD REQUEST', 400
 
-    if event_type in ['pull_request_review_comment', 'pull_request_review']:
-        check_conversation_resolution(webhook)
-    if event_type == 'issue_comment' and str(webhook.action).lower() == 'created':
-        check_conversation_resolution(webhook)
+    if not is_wanted(event_type, body):
+        return 'IGNORED', 200
 
-    if event_type == 'check_run' and str(webhook.action).lower() == 'rerequested':
-        if str(webhook.check_run.name) == 'Conversation Resolution':
-            check_conversation_resolution(webhook)
-        elif str(webhook.check_run.name) == 'Multiproduct Trunk Status':
-            check_trunk_status(webhook)
-        elif str(webhook.check_run.name) == 'PR Basic Information Check':
-            pr_template_check(webhook)
+    if not verify_signature(body, request.headers.get('X-Hub-Signature-256')):
+        log.warning(f'Dropping {event_type} delivery {delivery_id}, its signature does not match.')
+        return 'UNAUTHORIZED', 401
 
-    return 'GOOD'
+    try:
+        payload = json_decode.loads(body)
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        return 'BAD REQUEST', 400
+
+    if not claim_delivery(delivery_id):
+        return 'DUPLICATE', 200
+
+    webhook = WebhookView(payload, event_type)
+    # Journaled before being queued, so the checks it asks for are not lost on a restart.
+    jobs = record_jobs(webhook)
+
+    lane = RERUN if (event_type, webhook.action) in RERUN_EVENTS else INTERACTIVE
+    if not submit(handle_event, event_type, payload, webhook, jobs, lane=lane):
+        # Let GitHub's redelivery through, which journals the jobs again.
+        for job in jobs.values():
+            complete_job(job)
+        release_delivery(delivery_id)
+        return 'BUSY', 503, {'Retry-After': '5'}
+
+    return 'ACCEPTED', 202
+
+
+@app.route('/queue_status', methods=['GET'])
+def queue_status():
+    """The work queue of this process, or summed over the serving processes along with each of theirs."""
+    if not metrics.sharing():
+        return jsonify(queue_stats())
+
+    processes = {process: published['queue_status'] for process, published in metrics.shared_metrics().items()}
+    totals = {key: sum(stats.get(key, 0) for stats in processes.values())
+              for key in sorted({key for stats in processes.values() for key in stats})}
+    return jsonify(dict(totals, processes=processes))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Latency histograms plus queue, cache and rate limit gauges, in the Prometheus text format.
+
+    With several serving processes the histograms are summed over them, and the gauges have a `process` label.
+    """
+    if not metrics.sharing():
+        text = metrics.render(stats_gauges())
+    else:
+        published = metrics.shared_metrics()
+        gauges = [(name, dict(labels, process=process), value) for process, stats in sorted(published.items())
+                  for name, labels, value in stats['gauges']]
+        text = metrics.render(gauges, [stats['histograms'] for stats in published.values()])
+    return text, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def stats_gauges():
+    """Return the (name, labels, value) gauges of the queues, caches and rate limits."""
+    components = {
+        'work_queue': queue_stats(),
+        'debouncer': debounce_stats(),
+        'check_publisher': publisher_stats(),
+        'etag_cache': cache_stats(),
+        'commits_cache': commits_cache_stats(),
+        'idempotency': idempotency_stats(),
+        'job_journal': journal_stats(),
+        'policy_engine': engine_stats(),
+    }
+
+    gauges = []
+    for component, stats in components.items():
+        gauges.extend((f'bot_{component}_{key}', {}, value) for key, value in sorted(stats.items()))
+
+    for cache in ('etag_cache', 'commits_cache'):
+        hits, misses = components[cache].get('hits', 0), components[cache].get('misses', 0)
+        gauges.append(('bot_cache_hit_ratio', {'cache': cache}, hits / (hits + misses) if hits + misses else 0))
+
+    for (host, resource), state in sorted(rate_limit_status().items()):
+        gauges.extend((f'github_rate_limit_{key}', {'host': host, 'resource': resource}, value)
+                      for key, value in sorted(state.items()))
+
+    return gauges
+
+
+def handle_event(event_type, payload, webhook=None, jobs=None):
+    """Evaluate the policies interested in the given webhook event, completing their journaled jobs."""
+    webhook = webhook or WebhookView(payload, event_type)
+    jobs = jobs or {}
+    # Shared by the policies, so what they need about the PR is fetched only once.
+    context = PullRequestContext.from_webhook(webhook)
+    # The head SHA the results depend on, if they only depend on it
+    result_sha = webhook.pull_request.head_sha if (event_type, webhook.action) in SHA_DETERMINED_EVENTS and \
+        webhook.pull_request else None
+
+    policy_names = []
+    result_keys = []
+    for name in routed_policies(webhook):
+        result_key = (webhook.repository.full_name, webhook.pr_number, result_sha, name) if result_sha else None
+        if result_key and not claim_result(*result_key):
+            log.info(f'{name} already ran on {result_sha}, skipping {event_type} event.')
+            complete_job(jobs.get(name))
+            continue
+
+        if name in DEBOUNCED_POLICIES and webhook.pr_number:
+            debounce((webhook.repository.full_name, webhook.pr_number, name), run_job, (name,), webhook, None,
+                     {name: jobs.get(name)})
+            continue
+
+        policy_names.append(name)
+        if result_key:
+            result_keys.append(result_key)
+
+    if not policy_names:
+        return
+
+    # Evaluated together, so they share their GitHub calls and their check runs are published at once.
+    try:
+        run_job(policy_names, webhook, context, {name: jobs.get(name) for name in policy_names})
+    except Exception:
+        log.error(f'{", ".join(policy_names)} failed on {event_type} event.')
+        traceback.print_exc(file=sys.stderr)
+        for result_key in result_keys:
+            release_result(*result_key)
+
+
+def run_job(policy_names, webhook, context=None, jobs=None):
+    """Evaluate policies, then remove their jobs from the journal."""
+    try:
+        run_policies(webhook, context, policy_names)
+    finally:
+        for job in (jobs or {}).values():
+            complete_job(job)
+
+
+def routed_policies(webhook):
+    """Return the names of the policies a delivery asks for that are on for its repo."""
+    policy_names = route(webhook.event_type, webhook.action, webhook.check_run.name if webhook.check_run else None)
+    return enabled_policies(webhook.repository.full_name, policy_names) if policy_names and webhook.repository \
+        else ()
+
+
+def record_jobs(webhook):
+    """Journal the policies a delivery asks for on a PR. Return {policy name: job}."""
+    if not webhook.pr_number or not webhook.repository:
+        return {}
+
+    head_sha = (webhook.pull_request or webhook.check_run).head_sha if webhook.pull_request or webhook.check_run \
+        else None
+    return {name: record_job(webhook.repository.full_name, webhook.pr_number, name, head_sha,
+                             webhook.installation_id) for name in routed_policies(webhook)}
+
+
+def replay_job(job):
+    """Queue a job adopted from the journal of a process that stopped before running it."""
+    if job['check_name'] not in POLICIES:
+        log.warning(f'Dropping journaled job of unknown policy: {job}')
+        complete_job(job)
+        return
+
+    payload = {'repository': {'full_name': job['repo']}}
+    if job['installation_id']:
+        payload['installation'] = {'id': job['installation_id']}
+    # The PR may have moved on since, so the context looks up its current head SHA.
+    context = PullRequestContext(job['repo'], job['pr_number'], installation_id=job['installation_id'])
+
+    log.info(f'Replaying journaled {job["check_name"]} of {job["repo"]}#{job["pr_number"]}')
+    if not submit(run_job, (job['check_name'],), WebhookView(payload, 'journal'), context,
+                  {job['check_name']: job}, lane=RERUN):
+        log.warning(f'Work queue is full, {job} stays journaled.')
 
 
 @app.route('/run_conversation_resolution_scan/<owner>/<repo>', methods=['GET'])
 def run_conversation_resolution_scan(owner, repo):
-    run_conversation_check_scan_for_prs(owner, repo)
-    return 'GOOD'
+    """Queue a full scan of the repo, behind the webhook deliveries."""
+    if not submit(run_conversation_check_scan_for_prs, owner, repo, incremental=False, lane=BACKGROUND):
+        return 'BUSY', 503, {'Retry-After': '5'}
+    return 'QUEUED', 202
+
+
+"""
+SERVING
+========
+`python app.py` and `flask run` start the development server; production
+servers import the app from wsgi.py (see gunicorn.conf.py), which warms it up
+before the workers are forked and drains each worker when it stops.
+
+Every serving process calls `start` first, to replay the journaled jobs that
+stopped processes left over, and to publish its metrics for the others (see
+metrics.py).
+"""
+
+def warm_up():
+    """Check the configuration and load what every worker needs, once, before they are forked."""
+    validate_env_variables()
+    get_private_key()
+
+
+def start():
+    """Start the job journal of this serving process, and the sharing of its metrics."""
+    start_journal(replay_job)
+    metrics.start_sharing(lambda: dict(gauges=stats_gauges(), queue_status=queue_stats()))
+
+
+def drain(timeout):
+    """Finish the debounced and queued work and write the check runs out. Return False if not done in time."""
+    deadline = time.monotonic() + timeout
+    done = False
+    while not done and time.monotonic() < deadline:
+        # Handlers still running may debounce more calls.
+        run_pending()
+        done = join_queue(max(deadline - time.monotonic(), 0)) and not debounce_stats()['pending']
+
+    done = flush_checks(max(deadline - time.monotonic(), 0)) and done
+    # Whatever is left over gets adopted by another process.
+    release_jobs()
+    done = flush_journal(max(deadline - time.monotonic(), 0)) and done
+    if not done:
+        log.warning(f'Work left over after draining for {timeout}s: {queue_stats()}, {publisher_stats()}')
+    return done
 
 
-if __name__ == 'app' or __name__ == '__main__':
+# Started directly or by `flask run`, not when imported by a production server
+if __name__ == '__main__' or (__name__ == 'app' and os.getenv('FLASK_RUN_FROM_CLI') == 'true'):
     print(
         f'\n\033[96m\033[1m--- STARTING THE APP: [{datetime.datetime.now().strftime("%m/%d, %H:%M:%S")}] ---\033[0m \n')
     validate_env_variables()
+    start()
     app.run(port=8000)
@@ -0,0 +1,376 @@
+"""
+FAKE GITHUB
+============
+A local stand-in for the parts of the GitHub (Enterprise) API the bot uses, so
+it can be load tested offline:
+
+- POST  app/installations/{id}/access_tokens
+- GET   repos/{owner}/{repo}/pulls (paginated), pulls/{n} and pulls/{n}/commits
+- POST  repos/{owner}/{repo}/check-runs, PATCH repos/{owner}/{repo}/check-runs/{id}
+- POST  repos/{owner}/{repo}/issues/{n}/labels
+- POST  graphql, the review threads of a PR and the batched query of open PRs
+
+Every repo has PRs 1 to `prs` open, with made up (but stable) head SHAs, bodies,
+commits and review threads. Responses take `latency` seconds (give or take
+half), carry `ETag` (answering `304` to `If-None-Match`) and `X-RateLimit-*`
+headers, answer `403` once `rate_limit` calls were made in the current window
+(counted apart for REST and GraphQL calls, as GitHub does),
+and `502` for a `failure_rate` share of the calls. `GET /_stats` returns the
+calls made per endpoint.
+
+    python benchmarks/fake_github.py [--port 8800] [--prs 50] [--latency 0.05] [--rate-limit 5000] [--failure-rate 0]
+
+and point the bot at it with `API_BASE_URL=http://127.0.0.1:8800/api/v3` and
+`GQL_API_URL=http://127.0.0.1:8800/api/graphql`.
+"""
+import argparse
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+from urllib.parse import parse_qs, urlsplit
+
+# (method, path pattern, endpoint name), the names are what the call counts are reported by
+_ROUTES = [
+    ('POST', r'/api/v3/app/installations/(?P<installation_id>[^/]+)/access_tokens', 'access_tokens'),
+    ('GET', r'/api/v3/repos/(?P<repo>[^/]+/[^/]+)/pulls', 'pulls'),
+    ('GET', r'/api/v3/repos/(?P<repo>[^/]+/[^/]+)/pulls/(?P<number>\d+)', 'pull'),
+    ('GET', r'/api/v3/repos/(?P<repo>[^/]+/[^/]+)/pulls/(?P<number>\d+)/commits', 'pull_commits'),
+    ('POST', r'/api/v3/repos/(?P<repo>[^/]+/[^/]+)/check-runs', 'create_check_run'),
+    ('PATCH', r'/api/v3/repos/(?P<repo>[^/]+/[^/]+)/check-runs/(?P<check_run_id>\d+)', 'update_check_run'),
+    ('POST', r'/api/v3/repos/(?P<repo>[^/]+/[^/]+)/issues/(?P<number>\d+)/labels', 'labels'),
+    ('POST', r'/api/graphql', 'graphql'),
+]
+_ROUTES = [(method, re.compile(pattern + '$'), name) for method, pattern, name in _ROUTES]
+
+
+def _resource(name):
+    """Return the rate limit resource the calls to an endpoint count against."""
+    return 'graphql' if name == 'graphql' else 'core'
+
+_REVIEW_THREADS_QUERY = re.compile(r'pullRequest\(number:\s*(\d+)\)\s*{\s*reviewThreads\(first:\s*(\d+)'
+                                   r'(?:,\s*after:\s*"(\d*)")?')
+_OPEN_PULL_REQUESTS_QUERY = re.compile(r'pullRequests\(states:\s*OPEN,\s*first:\s*(\d+)(?:,\s*after:\s*"(\d*)")?')
+_THREADS_PER_PR = re.compile(r'reviewThreads\(first:\s*(\d+)\)')
+
+
+class FakeGitHub:
+    def __init__(self, prs=50, threads=10, commits=5, latency=0.0, rate_limit=5000, rate_limit_window=3600,
+                 failure_rate=0.0, seed=0):
+        self.prs = prs
+        self.threads = threads
+        self.commits = commits
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.failure_rate = failure_rate
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._calls = collections.Counter()
+        self._window_start = time.time()
+        # Rate limit resource (core, graphql) -> calls made in the current window
+        self._window_calls = collections.Counter()
+        self._check_run_ids = itertools.count(1)
+        self._server = None
+
+    def start(self, port=0):
+        """Serve in a background thread, and return the base URL."""
+        fake = self
+
+        class Handler(_Handler):
+            github = fake
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-github', daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    @property
+    def api_base_url(self):
+        return f'{self.base_url}/api/v3'
+
+    @property
+    def graphql_url(self):
+        return f'{self.base_url}/api/graphql'
+
+    def stats(self):
+        """Return the calls made per endpoint (and `total`), not counting 304s separately."""
+        with self._lock:
+            stats = dict(self._calls)
+        stats['total'] = sum(count for name, count in stats.items() if ':' not in name)
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            self._calls.clear()
+
+    def head_sha(self, repo, number):
+        return hashlib.sha1(f'{repo}#{number}'.encode('utf-8')).hexdigest()
+
+    def pull_request(self, repo, number):
+        return {
+            'number': number,
+            'state': 'open',
+            'title': f'Change {number}',
+            'body': '' if number % 5 == 0 else f'Change {number} of {repo}.\n\nTesting done: unit tests.',
+            'head': {'sha': self.head_sha(repo, number), 'ref': f'change-{number}'},
+            'base': {'ref': 'master'},
+            'updated_at': _timestamp(1_600_000_000 + number * 60),
+        }
+
+    def pull_request_commits(self, repo, number):
+        head_sha = self.head_sha(repo, number)
+        commits = []
+        for index in range(1 + number % self.commits):
+            sha = head_sha if index == 0 else hashlib.sha1(f'{head_sha}{index}'.encode('utf-8')).hexdigest()
+            message = f'Commit {index} of change {number}\n\n' + 'Describes the change in detail. ' * 10
+            if number % 10 == 0 and index == 0:
+                message += '\nTRUNKBLOCKERFIX'
+            commits.append({'sha': sha, 'commit': {'message': message,
+                                                   'author': {'name': 'author', 'email': 'author@example.com'}},
+                            'author': {'login': 'author'}, 'parents': [{'sha': 'e' * 40}]})
+        return commits
+
+    def review_threads(self, number):
+        total = (number * 7) % (self.threads + 1)
+        unresolved = number % 3 if total else 0
+        return [{'isResolved': index >= min(unresolved, total)} for index in range(total)]
+
+    def _admit(self, name):
+        """Count a call, and return the (status, message) it fails with, if any."""
+        resource = _resource(name)
+        with self._lock:
+            self._calls[name] += 1
+            if time.time() - self._window_start >= self.rate_limit_window:
+                self._window_start = time.time()
+                self._window_calls.clear()
+
+            if self._window_calls[resource] >= self.rate_limit:
+                self._calls['error:rate_limited'] += 1
+                return 403, 'API rate limit exceeded'
+            self._window_calls[resource] += 1
+
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self._calls['error:injected'] += 1
+                return 502, 'Server Error'
+        return None
+
+    def _rate_limit_headers(self, name):
+        resource = _resource(name)
+        with self._lock:
+            remaining = max(self.rate_limit - self._window_calls[resource], 0)
+            reset = int(self._window_start + self.rate_limit_window)
+        return {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(reset), 'X-RateLimit-Resource': resource}
+
+    def _count_not_modified(self, name):
+        with self._lock:
+            self._window_calls[_resource(name)] -= 1
+            self._calls['status:304'] += 1
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency * (0.5 + self._random.random()))
+
+    def handle(self, name, params, query, body, base_url):
+        """Return the (status, JSON document, headers) answering a call."""
+        if name == 'access_tokens':
+            return 201, {'token': f'v1.{params["installation_id"]}.{time.time()}',
+                         'expires_at': _timestamp(time.time() + 3600)}, {}
+
+        if name == 'pulls':
+            per_page = int(query.get('per_page', ['30'])[0])
+            page = int(query.get('page', ['1'])[0])
+            numbers = range((page - 1) * per_page + 1, min(page * per_page, self.prs) + 1)
+            headers = {}
+            if page * per_page < self.prs:
+                headers['Link'] = f'<{base_url}/api/v3/repos/{params["repo"]}/pulls' \
+                                  f'?per_page={per_page}&page={page + 1}>; rel="next"'
+            return 200, [self.pull_request(params['repo'], number) for number in numbers], headers
+
+        if name in ('pull', 'pull_commits', 'labels') and not 0 < int(params['number']) <= self.prs:
+            return 404, {'message': 'Not Found'}, {}
+
+        if name == 'pull':
+            return 200, self.pull_request(params['repo'], int(params['number'])), {}
+
+        if name == 'pull_commits':
+            return 200, self.pull_request_commits(params['repo'], int(params['number'])), {}
+
+        if name == 'create_check_run':
+            return 201, dict(body, id=next(self._check_run_ids)), {}
+
+        if name == 'update_check_run':
+            return 200, dict(body, id=int(params['check_run_id'])), {}
+
+        if name == 'labels':
+            return 200, [{'name': label} for label in body.get('labels', [])], {}
+
+        return 200, self._graphql(body.get('query', '')), {}
+
+    def _graphql(self, query):
+        threads_query = _REVIEW_THREADS_QUERY.search(query)
+        if threads_query:
+            number, first, after = int(threads_query.group(1)), int(threads_query.group(2)), threads_query.group(3)
+            start = int(after or 0)
+            threads = self.review_threads(number)
+            return {'data': {'repository': {'pullRequest': {'reviewThreads': {
+                'pageInfo': {'hasNextPage': start + first < len(threads), 'endCursor': str(start + first)},
+                'nodes': threads[start:start + first],
+            }}}}}
+
+        pulls_query = _OPEN_PULL_REQUESTS_QUERY.search(query)
+        if pulls_query:
+            first, start = int(pulls_query.group(1)), int(pulls_query.group(2) or 0)
+            threads_per_pr = int(_THREADS_PER_PR.search(query).group(1))
+            repo = '/'.join(re.search(r'owner:\s*"([^"]*)",\s*name:\s*"([^"]*)"', query).groups())
+            # Most recently updated first, which are the highest numbers here.
+            numbers = list(range(self.prs, 0, -1))[start:start + first]
+
+            nodes = []
+            for number in numbers:
+                threads = self.review_threads(number)
+                pull_request = self.pull_request(repo, number)
+                nodes.append({'number': number, 'headRefOid': pull_request['head']['sha'],
+                              'updatedAt': pull_request['updated_at'],
+                              'reviewThreads': {'totalCount': len(threads), 'nodes': threads[:threads_per_pr]}})
+
+            with self._lock:
+                remaining = max(self.rate_limit - self._window_calls['graphql'], 0)
+            return {'data': {
+                'repository': {'pullRequests': {
+                    'pageInfo': {'hasNextPage': start + first < self.prs, 'endCursor': str(start + first)},
+                    'nodes': nodes,
+                }},
+                'rateLimit': {'cost': 1, 'remaining': remaining},
+            }}
+
+        return {'errors': [{'message': 'Query not supported by the fake GitHub'}]}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    github = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+
+        if method == 'GET' and url.path == '/_stats':
+            return self._send(200, self.github.stats(), {})
+
+        for route_method, pattern, name in _ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self._send(404, {'message': 'Not Found'}, {})
+
+        github = self.github
+        github._delay()
+        failure = github._admit(name)
+        if failure:
+            return self._send(failure[0], {'message': failure[1]}, github._rate_limit_headers(name))
+
+        try:
+            body = json.loads(raw_body) if raw_body else {}
+        except ValueError:
+            return self._send(400, {'message': 'Problems parsing JSON'}, {})
+
+        status, document, headers = github.handle(name, match.groupdict(), parse_qs(url.query), body or {},
+                                                  github.base_url)
+        content = json.dumps(document).encode('utf-8')
+
+        if method == 'GET' and status == 200:
+            etag = f'"{hashlib.md5(content).hexdigest()}"'
+            headers['ETag'] = etag
+            # Like GitHub, a conditional request answered with 304 does not count against the rate limit.
+            if self.headers.get('If-None-Match') == etag:
+                github._count_not_modified(name)
+                return self._send(304, None, dict(headers, **github._rate_limit_headers(name)))
+
+        self._send(status, content, dict(headers, **github._rate_limit_headers(name)))
+
+    def _send(self, status, content, headers):
+        if content is not None and not isinstance(content, bytes):
+            content = json.dumps(content).encode('utf-8')
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if content is not None:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content or b'')))
+        self.end_headers()
+        if content:
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _timestamp(epoch):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+
+def add_arguments(parser):
+    """Add the options of the fake GitHub to an argument parser."""
+    parser.add_argument('--prs', type=int, default=50, help='open PRs per repo')
+    parser.add_argument('--threads', type=int, default=10, help='most review threads of a PR')
+    parser.add_argument('--commits', type=int, default=5, help='most commits of a PR')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds a call takes')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='calls per rate limit window')
+    parser.add_argument('--rate-limit-window', type=int, default=3600, help='seconds of a rate limit window')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of calls answered with 502')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args):
+    return FakeGitHub(prs=args.prs, threads=args.threads, commits=args.commits, latency=args.latency,
+                      rate_limit=args.rate_limit, rate_limit_window=args.rate_limit_window,
+                      failure_rate=args.failure_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake GitHub API for load testing the bot.')
+    parser.add_argument('--port', type=int, default=8800)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    github = from_arguments(args)
+    github.start(args.port)
+    print(f'API_BASE_URL={github.api_base_url}\nGQL_API_URL={github.graphql_url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        github.stop()
+
+
+if __name__ == '__main__':
+    main()
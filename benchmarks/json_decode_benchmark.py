@@ -0,0 +1,73 @@
+"""
+JSON DECODE BENCHMARK
+======================
+Decodes a large synthetic commit list (like `GET pulls/{n}/commits` of a big PR)
+the old way (`json.loads(response.text)`), from bytes with `json_decode.loads`,
+and extracting only the SHA and message of each commit with
+`json_decode.extract_fields`. Reports time and peak allocation of each.
+
+    python benchmarks/json_decode_benchmark.py [commits]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_decode
+
+
+def make_commit_list(count):
+    def person(name):
+        return {'name': name, 'email': f'{name}@example.com', 'date': '2019-09-16T19:04:13Z'}
+
+    def user(login):
+        return {'login': login, 'id': 1, 'type': 'User',
+                **{f'{name}_url': f'https://github.example.com/users/{login}/{name}' for name in
+                   ('avatar', 'html', 'followers', 'following', 'gists', 'starred', 'repos', 'events')}}
+
+    return [{
+        'sha': f'{number:040x}',
+        'url': f'https://github.example.com/api/v3/repos/o/r/commits/{number:040x}',
+        'commit': {'author': person('author'), 'committer': person('committer'),
+                   'message': f'Commit {number}\n\n' + 'Some long description of the change. ' * 40,
+                   'tree': {'sha': 'f' * 40, 'url': 'https://github.example.com/api/v3/repos/o/r/git/trees/x'},
+                   'comment_count': 0, 'verification': {'verified': False, 'reason': 'unsigned'}},
+        'author': user('author'), 'committer': user('committer'),
+        'parents': [{'sha': 'e' * 40, 'url': 'https://github.example.com/api/v3/repos/o/r/commits/x'}],
+    } for number in range(count)]
+
+
+def _measure(decode, content):
+    start = time.perf_counter()
+    result = decode(content)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    decode(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, len(result)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    content = json.dumps(make_commit_list(count)).encode('utf-8')
+
+    decoders = (
+        ('json.loads(text)', lambda body: json.loads(body.decode('utf-8'))),
+        ('json_decode.loads', json_decode.loads),
+        ('extract_fields', lambda body: list(json_decode.extract_fields(body, 'item', ('sha', 'commit.message')))),
+    )
+
+    print(f'{count} commits, {len(content) / 2 ** 20:.1f} MiB '
+          f'(orjson: {json_decode.orjson is not None}, ijson: {json_decode.ijson is not None})')
+    for label, decode in decoders:
+        elapsed, peak, items = _measure(decode, content)
+        print(f'{label:<18} {elapsed * 1e3:8.1f} ms  {peak / 2 ** 20:8.1f} MiB peak  ({items} items)')
+
+
+if __name__ == '__main__':
+    main()
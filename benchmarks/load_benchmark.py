@@ -0,0 +1,259 @@
+"""
+LOAD BENCHMARK
+===============
+Runs the bot against the fake GitHub of `fake_github.py`, offline:
+
+- `webhooks` replays a mix of webhook deliveries (PR pushes, edits, reviews,
+  comments, re-requested checks, redeliveries and events the bot ignores) at
+  `/webhook` of the app, in process, and reports events/s, the p50/p99 time from
+  receiving a delivery to its handlers being done, and GitHub calls per event.
+  With `--sweep N`, full scans of N repos are queued (in the background lane)
+  first, to see how much a sweep slows webhook driven checks down.
+- `scan` runs the conversation scan over `repos` repos of `prs` open PRs each,
+  for a few rounds (the first one full, the next ones incremental), and reports
+  the p50/p99 time to scan a repo and GitHub calls per PR.
+
+    python benchmarks/load_benchmark.py webhooks [--events 1000] [--rate 0] [--repos 10] [--prs 50] [--latency 0.02]
+        [--sweep 0]
+    python benchmarks/load_benchmark.py scan [--repos 10] [--prs 200] [--rounds 2] [--latency 0.02]
+
+The fake GitHub options (latency, rate limit, failure rate...) are listed with
+`--help`. The bot's own settings (WEBHOOK_WORKERS, GQL_SCAN_BATCH_SIZE...) come
+from the environment as usual; its state files go to a temporary directory.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import hmac
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import fake_github
+
+WEBHOOK_SECRET = 'load-benchmark'
+
+# (weight, event type, action), besides which a share of the deliveries are sent again
+WEBHOOK_MIX = [
+    (15, 'pull_request', 'synchronize'),
+    (5, 'pull_request', 'opened'),
+    (5, 'pull_request', 'edited'),
+    (10, 'pull_request_review', 'submitted'),
+    (15, 'pull_request_review_comment', 'created'),
+    (15, 'issue_comment', 'created'),
+    (5, 'check_run', 'rerequested'),
+    (20, 'push', None),
+    (10, 'status', None),
+]
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[int(round(share * (len(values) - 1)))] if values else 0.0
+
+
+def configure_bot(github, state_dir, debounce):
+    """Point the bot at the fake GitHub, before any of its modules is imported, and mint a token from it."""
+    os.environ.update(API_BASE_URL=github.api_base_url, GQL_API_URL=github.graphql_url, GH_APP_ID='1',
+                      SCAN_STATE_PATH='', IDEMPOTENCY_DB_PATH='',
+                      JOB_JOURNAL_PATH=os.path.join(state_dir, 'jobs.db'))
+    os.environ.setdefault('DEBOUNCE_DELAY', '5' if debounce else '0')
+    os.environ['GH_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    import gh_oauth_token
+
+    gh_oauth_token._token_storage_path = os.path.join(state_dir, '.secret')
+    gh_oauth_token._private_key_path = os.path.join(state_dir, 'gh-app.key')
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    with open(gh_oauth_token._private_key_path, 'wb') as key_file:
+        key_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                         serialization.NoEncryption()))
+
+    start = time.perf_counter()
+    gh_oauth_token.store_token(gh_oauth_token.get_token('1', '1'))
+    print(f'token minted in {(time.perf_counter() - start) * 1e3:.1f} ms')
+
+
+def load_app(debounce):
+    spec = importlib.util.spec_from_file_location('load_benchmark_app', os.path.join(REPO_DIR, 'app.py'))
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    if not debounce:
+        # Run every handler within the delivery, so its latency is measured.
+        app.DEBOUNCED_POLICIES = frozenset()
+    return app
+
+
+def make_delivery(rng, github, repos, event_type, action):
+    repo = rng.choice(repos)
+    number = rng.randint(1, github.prs)
+    pull_request = github.pull_request(repo, number)
+    # Like GitHub, `action` comes first.
+    payload = {'action': action} if action else {}
+    payload.update(repository={'full_name': repo}, installation={'id': 1})
+    if event_type == 'pull_request':
+        if action == 'synchronize':
+            pull_request['head']['sha'] = uuid.uuid4().hex + uuid.uuid4().hex[:8]
+        payload.update(number=number, pull_request=pull_request)
+    elif event_type in ('pull_request_review', 'pull_request_review_comment'):
+        payload['pull_request'] = pull_request
+        payload['comment' if event_type == 'pull_request_review_comment' else 'review'] = {'id': 1, 'body': 'nit'}
+    elif event_type == 'issue_comment':
+        payload['issue'] = {'number': number, 'pull_request': {'url': f'{github.api_base_url}/repos/{repo}/pulls/{number}'}}
+        payload['comment'] = {'id': 1, 'body': 'Looks good'}
+    elif event_type == 'check_run':
+        payload['check_run'] = {'name': 'Conversation Resolution', 'head_sha': pull_request['head']['sha'],
+                                'pull_requests': [{'number': number}]}
+    elif event_type == 'push':
+        payload.update(ref='refs/heads/master', commits=github.pull_request_commits(repo, number))
+    else:
+        payload.update(sha=pull_request['head']['sha'], state='success')
+
+    return event_type, str(uuid.uuid4()), payload
+
+
+def run_webhooks(args, github):
+    app = load_app(args.debounce)
+    import check_publisher
+
+    latencies = []
+    done = threading.Semaphore(0)
+    handle_event = app.handle_event
+
+    def timed_handle_event(event_type, payload, *args):
+        try:
+            handle_event(event_type, payload, *args)
+        finally:
+            latencies.append(time.perf_counter() - payload['_sent_at'])
+            done.release()
+
+    app.handle_event = timed_handle_event
+    client = app.app.test_client()
+
+    rng = random.Random(args.seed)
+    repos = [f'bench/repo-{index}' for index in range(args.repos)]
+    weights = [weight for weight, _, _ in WEBHOOK_MIX]
+    sent = []
+    answers = {}
+
+    github.reset_stats()
+    start = time.perf_counter()
+    for repo in repos[:args.sweep]:
+        client.get(f'/run_conversation_resolution_scan/{repo}')
+
+    for index in range(args.events):
+        if sent and rng.random() < args.duplicate_rate:
+            event_type, delivery_id, payload = rng.choice(sent)
+        else:
+            _, event_type, action = rng.choices(WEBHOOK_MIX, weights)[0]
+            event_type, delivery_id, payload = make_delivery(rng, github, repos, event_type, action)
+            sent.append((event_type, delivery_id, payload))
+
+        payload['_sent_at'] = time.perf_counter()
+        body = json.dumps(payload).encode('utf-8')
+        signature = 'sha256=' + hmac.new(WEBHOOK_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        response = client.post('/webhook', data=body, content_type='application/json',
+                               headers={'X-Github-Event': event_type, 'X-GitHub-Delivery': delivery_id,
+                                        'X-Hub-Signature-256': signature})
+        answer = response.get_data(as_text=True)
+        answers[answer] = answers.get(answer, 0) + 1
+
+        if args.rate:
+            time.sleep(max(start + (index + 1) / args.rate - time.perf_counter(), 0))
+
+    for _ in range(answers.get('ACCEPTED', 0)):
+        done.acquire()
+    handled = time.perf_counter() - start
+    app.join_queue()
+    check_publisher.flush()
+    elapsed = time.perf_counter() - start
+
+    calls = github.stats()
+    print(f'{args.events} deliveries: {answers.get("ACCEPTED", 0)} handled, {answers.get("IGNORED", 0)} ignored, '
+          f'{answers.get("DUPLICATE", 0)} duplicates dropped, {answers.get("BUSY", 0)} rejected as busy')
+    print(f'{args.events / elapsed:.1f} events/s ({handled:.2f}s to handle, {elapsed:.2f}s with '
+          f'{"sweeps and " if args.sweep else ""}check runs written)')
+    print(f'receipt to handled: p50 {percentile(latencies, 0.5) * 1e3:.1f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1e3:.1f} ms')
+    print(f'GitHub calls: {calls["total"]} ({calls["total"] / max(args.events, 1):.2f} per event)')
+    print_calls(calls)
+
+
+def run_scan(args, github):
+    import webhook_handlers
+
+    repos = [('bench', f'repo-{index}') for index in range(args.repos)]
+
+    def scan(owner, repo):
+        start = time.perf_counter()
+        webhook_handlers.run_conversation_check_scan_for_prs(owner, repo, batched=not args.unbatched)
+        return time.perf_counter() - start
+
+    import check_publisher
+    with concurrent.futures.ThreadPoolExecutor(args.parallel) as executor:
+        for round_number in range(1, args.rounds + 1):
+            github.reset_stats()
+            start = time.perf_counter()
+            durations = list(executor.map(lambda target: scan(*target), repos))
+            check_publisher.flush()
+            elapsed = time.perf_counter() - start
+
+            calls = github.stats()
+            pr_count = args.repos * github.prs
+            print(f'round {round_number}: {args.repos} repos x {github.prs} PRs in {elapsed:.2f}s '
+                  f'({pr_count / elapsed:.1f} PRs/s)')
+            print(f'  repo scan: p50 {percentile(durations, 0.5) * 1e3:.1f} ms, '
+                  f'p99 {percentile(durations, 0.99) * 1e3:.1f} ms')
+            print(f'  GitHub calls: {calls["total"]} ({calls["total"] / pr_count:.3f} per PR)')
+            print_calls(calls, indent='  ')
+
+
+def print_calls(calls, indent=''):
+    for name, count in sorted(calls.items()):
+        if name != 'total':
+            print(f'{indent}  {name:<20} {count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the bot against a fake GitHub.')
+    parser.add_argument('mode', choices=('webhooks', 'scan'))
+    parser.add_argument('--repos', type=int, default=10)
+    parser.add_argument('--events', type=int, default=1000, help='webhook deliveries to send')
+    parser.add_argument('--rate', type=float, default=0, help='deliveries per second (0 sends them all at once)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='share of deliveries sent again')
+    parser.add_argument('--debounce', action='store_true', help='keep debouncing the conversation check')
+    parser.add_argument('--sweep', type=int, default=0, help='repos scanned in the background during the deliveries')
+    parser.add_argument('--rounds', type=int, default=2, help='scans of every repo')
+    parser.add_argument('--parallel', type=int, default=8, help='repos scanned at the same time')
+    parser.add_argument('--unbatched', action='store_true', help='query the PRs one by one')
+    fake_github.add_arguments(parser)
+    args = parser.parse_args()
+
+    github = fake_github.from_arguments(args)
+    github.start()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        configure_bot(github, state_dir, args.debounce)
+        if args.mode == 'webhooks':
+            run_webhooks(args, github)
+        else:
+            run_scan(args, github)
+
+    github.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+OVERRIDE SCAN BENCHMARK
+========================
+Scans the commit messages of a large synthetic PR (a cherry-pick train) for
+overrides the way the handlers used to (nested loop over messages and overrides,
+plus a separate TRUNKBLOCKERFIX scan, on every sync) and with
+`override_scanner.find_commit_overrides`, on the first sync and on later syncs
+that only add a few commits.
+
+    python benchmarks/override_scan_benchmark.py [commits] [syncs]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import OVERRIDE_ALLOWED
+
+import override_scanner
+
+
+def make_commits(count, start=0):
+    commits = []
+    for number in range(start, start + count):
+        words = [''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 10))) for _ in range(300)]
+        if number % 40 == 0:
+            words.insert(random.randrange(len(words)), random.choice(OVERRIDE_ALLOWED))
+        commits.append({'sha': f'{number:040x}', 'commit': {'message': ' '.join(words)}})
+    return commits
+
+
+def scan_like_before(commits):
+    commit_messages = [str(commit['commit']['message']) for commit in commits]
+    found_override = any(['TRUNKBLOCKERFIX' in commit_message for commit_message in commit_messages])
+
+    override_used = set()
+    for commit_message in commit_messages:
+        for allowed_override in OVERRIDE_ALLOWED:
+            if allowed_override in commit_message:
+                override_used.add(allowed_override)
+    return found_override, override_used
+
+
+def scan_with_scanner(commits):
+    overrides = override_scanner.find_commit_overrides(commits)
+    return 'TRUNKBLOCKERFIX' in overrides, overrides
+
+
+def _time_syncs(scan, syncs):
+    start = time.perf_counter()
+    for commits in syncs:
+        result = scan(commits)
+    return (time.perf_counter() - start) / len(syncs), result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    sync_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    random.seed(0)
+
+    # Every sync pushes two more commits onto the PR.
+    commits = make_commits(count)
+    syncs = [commits]
+    for sync in range(1, sync_count):
+        syncs.append(syncs[-1] + make_commits(2, count + 2 * sync))
+
+    before, before_result = _time_syncs(scan_like_before, syncs)
+    first, _ = _time_syncs(scan_with_scanner, syncs[:1])
+    later, after_result = _time_syncs(scan_with_scanner, syncs[1:])
+    assert before_result == (after_result[0], set(after_result[1]))
+
+    print(f'{count} commits, {sync_count} syncs, overrides found: {sorted(after_result[1])}')
+    print(f'nested loop, every sync:         {before * 1e3:8.2f} ms/sync')
+    print(f'override scanner, first sync:    {first * 1e3:8.2f} ms/sync')
+    print(f'override scanner, later syncs:   {later * 1e3:8.2f} ms/sync')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+PAYLOAD VIEW BENCHMARK
+=======================
+Compares reading the fields the handlers use from a large `pull_request`
+webhook through `ObjectifyJSON` (as the handlers used to) and through
+`payload_views.WebhookView`: CPU time and peak allocation per event.
+
+    python benchmarks/payload_view_benchmark.py [iterations]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from objectify_json import ObjectifyJSON
+
+from payload_views import WebhookView
+
+
+def _user(login):
+    return {'login': login, 'id': hash(login) & 0xffff, 'type': 'User', 'site_admin': False,
+            **{f'{name}_url': f'https://github.example.com/users/{login}/{name}' for name in
+               ('avatar', 'html', 'followers', 'following', 'gists', 'starred', 'subscriptions', 'organizations',
+                'repos', 'events', 'received_events')}}
+
+
+def _repo(full_name):
+    owner, _, name = full_name.partition('/')
+    return {'id': 42, 'name': name, 'full_name': full_name, 'private': False, 'owner': _user(owner),
+            'description': 'x' * 200, 'default_branch': 'master',
+            **{f'{name}_url': f'https://github.example.com/api/v3/repos/{full_name}/{name}' for name in
+               ('forks', 'keys', 'collaborators', 'teams', 'hooks', 'issue_events', 'events', 'assignees',
+                'branches', 'tags', 'blobs', 'git_tags', 'git_refs', 'trees', 'statuses', 'languages',
+                'stargazers', 'contributors', 'subscribers', 'subscription', 'commits', 'git_commits',
+                'comments', 'issue_comment', 'contents', 'compare', 'merges', 'archive', 'downloads', 'issues',
+                'pulls', 'milestones', 'notifications', 'labels', 'releases', 'deployments')}}
+
+
+def make_pull_request_payload():
+    repo = _repo('li-foundation/zac-test-repo')
+    return {
+        'action': 'synchronize',
+        'number': 1234,
+        'pull_request': {
+            'number': 1234, 'state': 'open', 'title': 'A change', 'user': _user('author'),
+            'body': 'Lorem ipsum dolor sit amet. ' * 2000,
+            'labels': [{'id': i, 'name': f'label-{i}', 'color': 'ffffff'} for i in range(20)],
+            'requested_reviewers': [_user(f'reviewer-{i}') for i in range(20)],
+            'head': {'label': 'author:branch', 'ref': 'branch', 'sha': 'a' * 40, 'user': _user('author'),
+                     'repo': repo},
+            'base': {'label': 'li-foundation:master', 'ref': 'master', 'sha': 'b' * 40,
+                     'user': _user('li-foundation'), 'repo': repo},
+            'updated_at': '2019-09-16T19:04:13Z', 'commits': 300, 'additions': 10000, 'deletions': 5000,
+        },
+        'repository': repo,
+        'sender': _user('author'),
+        'installation': {'id': 7},
+    }
+
+
+def read_with_objectify_json(payload):
+    webhook = ObjectifyJSON(payload)
+    # What the three handlers and the router read from a `synchronize` event.
+    for _ in range(3):
+        str(webhook.action).lower()
+    for _ in range(3):
+        repo_full_name = str(webhook.repository.full_name)
+        if webhook.pull_request:
+            str(webhook.pull_request.number)
+            str(webhook.pull_request.head.sha)
+    str(webhook.pull_request.body)
+    return repo_full_name
+
+
+def read_with_view(payload):
+    webhook = WebhookView(payload, 'pull_request')
+    for _ in range(3):
+        webhook.action
+    for _ in range(3):
+        repo_full_name = webhook.repository.full_name
+        if webhook.pull_request:
+            webhook.pull_request.number
+            webhook.pull_request.head_sha
+    webhook.pull_request.body
+    return repo_full_name
+
+
+def _measure(reader, payload, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        reader(payload)
+    per_event = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    reader(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return per_event, peak
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    payload = make_pull_request_payload()
+
+    for label, reader in (('ObjectifyJSON', read_with_objectify_json), ('WebhookView', read_with_view)):
+        per_event, peak = _measure(reader, payload, iterations)
+        print(f'{label:<14} {per_event * 1e6:8.1f} us/event  {peak / 1024:8.1f} KiB peak allocation/event')
+
+
+if __name__ == '__main__':
+    main()
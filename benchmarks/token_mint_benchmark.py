@@ -0,0 +1,63 @@
+"""
+TOKEN MINT BENCHMARK
+=====================
+Measures how many installation tokens `get_token` can mint per second, with the
+private key and app JWT caches defeated ("before") and in use ("after").
+GitHub is stubbed out, so only key loading, JWT signing and JSON handling are timed.
+
+    python benchmarks/token_mint_benchmark.py [iterations]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import gh_oauth_token
+
+
+class _FakeResponse:
+    text = json.dumps({'token': 'v1.fake', 'expires_at': '2099-01-01T00:00:00Z'})
+
+
+def _write_private_key(directory):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    path = os.path.join(directory, 'gh-app.key')
+    with open(path, 'wb') as key_file:
+        key_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                         serialization.NoEncryption()))
+    return path
+
+
+def _mints_per_second(iterations, cached):
+    start = time.perf_counter()
+    for installation_id in range(iterations):
+        if not cached:
+            gh_oauth_token._private_key = None
+            gh_oauth_token._app_jwts.clear()
+        gh_oauth_token.get_token('12345', installation_id)
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    with tempfile.TemporaryDirectory() as directory:
+        gh_oauth_token._private_key_path = _write_private_key(directory)
+        gh_oauth_token.request = lambda method, url, **kwargs: _FakeResponse()
+
+        before = _mints_per_second(iterations, cached=False)
+        after = _mints_per_second(iterations, cached=True)
+
+    print(f'token mints/sec without key & JWT cache: {before:10.1f}')
+    print(f'token mints/sec with key & JWT cache:    {after:10.1f}  ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
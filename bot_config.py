@@ -22,10 +22,119 @@ You'll get warnings if any of these are unset
 GH_USER = os.getenv("GH_USER", -1)
 GH_USER_TOKEN = os.getenv("GH_USER_TOKEN", -1)
 API_BASE_URL = os.getenv("API_BASE_URL", -1)
+GQL_API_URL = os.getenv("GQL_API_URL", "https://ghetest.trafficmanager.net/api/graphql")
 GH_APP_ID = os.getenv("GH_APP_ID", -1)
 GH_APP_CLIENT_ID = os.getenv("GH_APP_CLIENT_ID", -1)
 GH_APP_CLIENT_SECRET = os.getenv("GH_APP_CLIENT_SECRET", -1)
 GH_APP_PRIVATE_KEY_PATH = os.getenv("GH_APP_PRIVATE_KEY_PATH", -1)
+GH_WEBHOOK_SECRET = os.getenv("GH_WEBHOOK_SECRET", -1)
+
+
+"""
+TUNING
+=======
+Knobs with sensible defaults, so they are not reported by validate_env_variables
+"""
+
+
+# Number of threads handling queued webhook deliveries, and how many deliveries may wait for them
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# Workers only interactive jobs may use (see priority.py), and how many workers background jobs may use at most
+WEBHOOK_RESERVED_WORKERS = int(os.getenv("WEBHOOK_RESERVED_WORKERS", 1))
+WEBHOOK_BACKGROUND_WORKERS = int(os.getenv("WEBHOOK_BACKGROUND_WORKERS", 1))
+
+# Threads writing check runs to GitHub, and how many published check runs are remembered to skip identical writes
+CHECK_PUBLISH_WORKERS = int(os.getenv("CHECK_PUBLISH_WORKERS", 4))
+# Threads writing the check runs of background scans, apart from the others
+CHECK_PUBLISH_BACKGROUND_WORKERS = int(os.getenv("CHECK_PUBLISH_BACKGROUND_WORKERS", 2))
+CHECK_PUBLISH_HISTORY = int(os.getenv("CHECK_PUBLISH_HISTORY", 10000))
+
+# Seconds a debounced check waits for more events on the same PR, and at most since the first one (0 disables)
+DEBOUNCE_DELAY = float(os.getenv("DEBOUNCE_DELAY", 5))
+DEBOUNCE_MAX_WAIT = float(os.getenv("DEBOUNCE_MAX_WAIT", 30))
+
+# Keep-alive connections kept per GitHub host for synchronous calls (the async client's calls come on top),
+# and how failed calls are retried
+GH_HTTP_POOL_SIZE = int(os.getenv("GH_HTTP_POOL_SIZE", 10))
+GH_HTTP_TIMEOUT = float(os.getenv("GH_HTTP_TIMEOUT", 30))
+GH_HTTP_MAX_RETRIES = int(os.getenv("GH_HTTP_MAX_RETRIES", 3))
+GH_HTTP_BACKOFF = float(os.getenv("GH_HTTP_BACKOFF", 0.5))
+# Once fewer calls than this are left in the rate limit window, calls are spread over the rest of the window
+GH_RATE_LIMIT_RESERVE = int(os.getenv("GH_RATE_LIMIT_RESERVE", 100))
+# Shares of the rate limit window reruns and background scans leave to more urgent work: they wait for the
+# window to reset once less than this share of it remains
+GH_QUOTA_RESERVE_RERUN = float(os.getenv("GH_QUOTA_RESERVE_RERUN", 0.05))
+GH_QUOTA_RESERVE_BACKGROUND = float(os.getenv("GH_QUOTA_RESERVE_BACKGROUND", 0.25))
+# Seconds an interactive call waits at most for rate limit quota; beyond that it fails fast rather than hold up
+# a webhook worker until the window resets
+GH_INTERACTIVE_MAX_QUOTA_WAIT = float(os.getenv("GH_INTERACTIVE_MAX_QUOTA_WAIT", 10))
+
+# Seconds the commits of a PR head SHA are reused across events, and how many head SHAs are kept
+PR_CONTEXT_TTL = float(os.getenv("PR_CONTEXT_TTL", 60))
+PR_CONTEXT_CACHE_SIZE = int(os.getenv("PR_CONTEXT_CACHE_SIZE", 256))
+
+# Bytes and entries of REST GET responses kept for conditional (If-None-Match) requests, 0 bytes disables
+GH_ETAG_CACHE_BYTES = int(os.getenv("GH_ETAG_CACHE_BYTES", 32 * 1024 * 1024))
+GH_ETAG_CACHE_ENTRIES = int(os.getenv("GH_ETAG_CACHE_ENTRIES", 1024))
+
+# GitHub calls the async client keeps in flight at most: overall, per host and per installation
+GH_ASYNC_MAX_IN_FLIGHT = int(os.getenv("GH_ASYNC_MAX_IN_FLIGHT", 64))
+GH_ASYNC_PER_HOST = int(os.getenv("GH_ASYNC_PER_HOST", 32))
+GH_ASYNC_PER_INSTALLATION = int(os.getenv("GH_ASYNC_PER_INSTALLATION", 16))
+
+# SQLite database through which the processes of the bot share installation tokens and handled deliveries,
+# instead of the secret file and their own memory (empty to not share them, the production server sets it)
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "")
+
+# Webhook deliveries and check results remembered per kind to drop duplicates, for how many seconds, and the
+# SQLite database keeping them across restarts and processes (empty to keep them in memory only)
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 60 * 60))
+IDEMPOTENCY_DB_PATH = os.getenv("IDEMPOTENCY_DB_PATH", SHARED_STATE_PATH)
+
+# Items per page when walking paginated REST lists and GraphQL connections (at most 100)
+GH_PAGE_SIZE = int(os.getenv("GH_PAGE_SIZE", 100))
+
+# Open PRs fetched per GraphQL query by the conversation scan, review threads fetched along with each of them,
+# and the GraphQL rate limit points a single scan of a repo may spend
+GQL_SCAN_BATCH_SIZE = int(os.getenv("GQL_SCAN_BATCH_SIZE", 50))
+GQL_SCAN_THREADS_PER_PR = int(os.getenv("GQL_SCAN_THREADS_PER_PR", 100))
+GQL_SCAN_COST_BUDGET = int(os.getenv("GQL_SCAN_COST_BUDGET", 100))
+
+# Where the scan remembers what it saw of each PR (empty to keep it in memory only), and how often a repo
+# gets a full scan instead of only looking at PRs updated since the previous scan
+SCAN_STATE_PATH = os.getenv("SCAN_STATE_PATH", "private/.scan_state")
+SCAN_FULL_RESCAN_INTERVAL = int(os.getenv("SCAN_FULL_RESCAN_INTERVAL", 600))
+
+# Repos scanned by conversation_resolution_scan.py, as `owner/repo[:interval]` separated by commas or whitespace
+# (or one per line in SCAN_TARGETS_FILE), the default interval and jitter in seconds, and how many repos
+# may be scanned at the same time
+SCAN_TARGETS = os.getenv("SCAN_TARGETS", "li-foundation/zac-test-repo")
+SCAN_TARGETS_FILE = os.getenv("SCAN_TARGETS_FILE", "")
+SCAN_INTERVAL = int(os.getenv("SCAN_INTERVAL", 10))
+SCAN_JITTER = int(os.getenv("SCAN_JITTER", 5))
+SCAN_MAX_PARALLEL = int(os.getenv("SCAN_MAX_PARALLEL", 8))
+
+# JSON file of the policy settings (see policy_engine.py) per repo, owner or every repo (empty for the defaults)
+POLICY_CONFIG_PATH = os.getenv("POLICY_CONFIG_PATH", "")
+
+# Where the checks still owed are journaled so they survive restarts (empty to not journal them), seconds of
+# journal changes committed together, and seconds after which the jobs of a stopped process are run again
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", "private/.jobs.db")
+JOB_JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOB_JOURNAL_FLUSH_INTERVAL", 0.05))
+JOB_JOURNAL_LEASE = int(os.getenv("JOB_JOURNAL_LEASE", 30))
+
+# Production server (gunicorn.conf.py): address, worker processes, threads per worker, and seconds a stopping
+# worker gets to finish its queued work
+SERVER_BIND = os.getenv("SERVER_BIND", "0.0.0.0:8000")
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1))
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", 4))
+SERVER_DRAIN_TIMEOUT = int(os.getenv("SERVER_DRAIN_TIMEOUT", 30))
+
+# Seconds between the metrics each serving process publishes to the shared store, for `/metrics` and
+# `/queue_status` to cover every worker
+METRICS_SHARE_INTERVAL = float(os.getenv("METRICS_SHARE_INTERVAL", 5))
 
 
 def validate_env_variables():
@@ -36,7 +145,8 @@ def validate_env_variables():
         "GH_APP_ID": GH_APP_ID,
         "GH_APP_CLIENT_ID": GH_APP_CLIENT_ID,
         "GH_APP_CLIENT_SECRET": GH_APP_CLIENT_SECRET,
-        "GH_APP_PRIVATE_KEY_PATH": GH_APP_PRIVATE_KEY_PATH
+        "GH_APP_PRIVATE_KEY_PATH": GH_APP_PRIVATE_KEY_PATH,
+        "GH_WEBHOOK_SECRET": GH_WEBHOOK_SECRET
     }
 
     blanks_msg = reduce(lambda acc, item:
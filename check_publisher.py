@@ -0,0 +1,200 @@
+import collections
+import itertools
+import logging
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from bot_config import CHECK_PUBLISH_BACKGROUND_WORKERS, CHECK_PUBLISH_HISTORY, CHECK_PUBLISH_WORKERS
+from gh_utils import set_check_on_pr
+from priority import BACKGROUND, INTERACTIVE, current_lane, ensure_thread, in_lane, rank
+
+log = logging.getLogger(__name__)
+
+"""
+CHECK PUBLISHER
+================
+Writes check runs to GitHub from a pool of outbound threads, keeping writes down:
+
+- the check run created for a (repo, check name, head SHA) is updated (PATCH)
+  from then on, instead of creating a new one each time,
+- a write whose status, conclusion and output equal what was last published is
+  skipped, and so is an `in_progress` write once the check run exists,
+- while a write waits for a thread, a newer write of the same check run
+  replaces it (e.g. `completed` replacing `in_progress`).
+
+Writes are taken in the order of the priority lane they were published from
+(see priority.py). Those of the background lane have threads of their own
+(CHECK_PUBLISH_BACKGROUND_WORKERS), which wait while the rate limit is kept for
+more urgent lanes, so a sweep's writes never hold up a developer's check.
+"""
+
+_BACKGROUND_RANK = rank(BACKGROUND)
+
+# (repo_full_name, check_name, head_sha) -> the latest write waiting for a thread
+_pending = {}
+# (repo_full_name, check_name, head_sha) -> dict(id, status, conclusion, title, summary) of the published check run
+_published = collections.OrderedDict()
+# Keys of the check runs a thread is writing right now
+_writing = set()
+_lock = threading.Lock()
+# (lane rank, sequence number, key) of the check runs to write, for the interactive and rerun lanes, and for
+# the background lane
+_queue = queue.PriorityQueue()
+_background_queue = queue.PriorityQueue()
+_sequence = itertools.count()
+_workers = []
+_background_workers = []
+_counters = collections.Counter()
+
+
+def publish_check(repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title=None,
+                  output_summary=None, installation_id=None):
+    """Queue a check run write, with the same arguments as `gh_utils.set_check_on_pr`."""
+    publish_checks([(repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title,
+                     output_summary, installation_id)])
+
+
+def publish_checks(checks):
+    """Queue check run writes together, each a tuple of the arguments of `publish_check`."""
+    check_rank = rank(current_lane())
+    enqueued = []
+
+    with _lock:
+        _start_workers()
+        for repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title, output_summary, \
+                installation_id in checks:
+            key = (repo_full_name, check_name, head_sha)
+            check = dict(status=check_status, conclusion=check_conclusion, title=output_title,
+                         summary=output_summary, installation_id=installation_id, rank=check_rank)
+
+            previous = _pending.get(key)
+            if previous:
+                check['rank'] = min(check['rank'], previous['rank'])
+            _pending[key] = check
+            _counters['replaced' if previous else 'queued'] += 1
+            # A thread busy writing this check run picks the new write up when it is done. A write of a more
+            # urgent lane replacing a waiting one is queued again, at its own rank.
+            if key not in _writing and (not previous or check['rank'] < previous['rank']):
+                enqueued.append((key, check['rank']))
+
+    for key, key_rank in enqueued:
+        _enqueue(key, key_rank)
+
+
+def flush(timeout=None):
+    """Wait until the queued writes are done. Return False if they are not done within the timeout."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    # Background threads may hand a write over to the other queue, so that one is waited for last.
+    for work_queue in (_background_queue, _queue):
+        with work_queue.all_tasks_done:
+            while work_queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                work_queue.all_tasks_done.wait(remaining)
+    return True
+
+
+def publisher_stats():
+    """Return how many writes were queued, replaced, skipped and sent."""
+    with _lock:
+        stats = dict(_counters)
+        stats['pending'] = len(_pending)
+    return stats
+
+
+def _enqueue(key, check_rank):
+    entry = (check_rank, next(_sequence), key)
+    (_background_queue if check_rank >= _BACKGROUND_RANK else _queue).put(entry)
+
+
+def _start_workers():
+    for workers, count, work_queue, lane in ((_workers, CHECK_PUBLISH_WORKERS, _queue, INTERACTIVE),
+                                             (_background_workers, CHECK_PUBLISH_BACKGROUND_WORKERS,
+                                              _background_queue, BACKGROUND)):
+        prefix = 'check-publisher-background-' if lane == BACKGROUND else 'check-publisher-'
+        workers[:] = [ensure_thread(workers[index] if index < len(workers) else None, f'{prefix}{index}',
+                                    _publish_loop, work_queue, lane) for index in range(count)]
+
+
+def _publish_loop(work_queue, lane):
+    # GitHub calls of the background lane wait while the rate limit is kept for the other lanes.
+    with in_lane(lane):
+        while True:
+            _, _, key = work_queue.get()
+            try:
+                _publish_key(key, lane == BACKGROUND)
+            finally:
+                work_queue.task_done()
+
+
+def _publish_key(key, background):
+    writing = False
+    # Writes of one check run happen one after the other, so it is never created twice.
+    while True:
+        with _lock:
+            if not writing and key in _writing:
+                # Queued twice (see publish_check), another thread is writing it.
+                return
+            check = _pending.get(key)
+            if check is None or (background and check['rank'] < _BACKGROUND_RANK):
+                if writing:
+                    _writing.discard(key)
+                break
+            del _pending[key]
+            _writing.add(key)
+            writing = True
+
+        try:
+            _write(key, check)
+        except Exception:
+            log.error(f'Could not publish check {key}.')
+            traceback.print_exc(file=sys.stderr)
+
+    # A more urgent write came in while this background thread was writing the check run, hand it over.
+    if check is not None and writing:
+        _enqueue(key, check['rank'])
+
+
+def _write(key, check):
+    repo_full_name, check_name, head_sha = key
+    content = dict(status=check['status'], conclusion=check['conclusion'], title=check['title'],
+                   summary=check['summary'])
+
+    with _lock:
+        published = _published.get(key)
+
+    if published and (check['status'] != 'completed' or
+                      all(published[field] == value for field, value in content.items())):
+        _count('skipped')
+        return
+
+    response = set_check_on_pr(repo_full_name, check_name, check['status'], check['conclusion'], head_sha,
+                               check['title'], check['summary'], check['installation_id'],
+                               published['id'] if published else None)
+
+    if published and not (response or {}).get('id'):
+        # The check run may be gone, create a new one.
+        _count('recreated')
+        response = set_check_on_pr(repo_full_name, check_name, check['status'], check['conclusion'], head_sha,
+                                   check['title'], check['summary'], check['installation_id'])
+
+    if not (response or {}).get('id'):
+        log.error(f'Could not publish check {check_name} on {repo_full_name}@{head_sha}: {response}')
+        _count('failed')
+        return
+
+    _count('updated' if published else 'created')
+    with _lock:
+        _published[key] = dict(content, id=response['id'])
+        _published.move_to_end(key)
+        while len(_published) > CHECK_PUBLISH_HISTORY:
+            _published.popitem(last=False)
+
+
+def _count(counter):
+    with _lock:
+        _counters[counter] += 1
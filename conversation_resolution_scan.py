@@ -1,12 +1,73 @@
-import time
+import datetime
+import logging
+import random
+import re
 
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+
+from bot_config import SCAN_INTERVAL, SCAN_JITTER, SCAN_MAX_PARALLEL, SCAN_TARGETS, SCAN_TARGETS_FILE
+from priority import BACKGROUND, run_in_lane
 from webhook_handlers import run_conversation_check_scan_for_prs
 
+log = logging.getLogger(__name__)
+
+"""
+CONVERSATION RESOLUTION SCAN
+=============================
+Periodically scans the open PRs of every target repo. Repos are scanned
+concurrently (up to SCAN_MAX_PARALLEL at a time), each on its own interval with
+some jitter so they don't all hit GitHub at once, and a repo whose previous
+scan is still running is skipped until the next round.
+
+Scans run in the background lane (see priority.py): they stop calling GitHub
+while the rate limit left is within the share kept for webhook driven checks.
+"""
+
+
+def load_scan_targets(targets=SCAN_TARGETS, targets_file=SCAN_TARGETS_FILE, default_interval=SCAN_INTERVAL):
+    """Return the (owner, repo, interval) of every repo to scan."""
+    if targets_file:
+        with open(targets_file) as file:
+            targets = '\n'.join(line.split('#')[0] for line in file)
+
+    scan_targets = []
+    for target in re.split(r'[\s,]+', targets.strip()):
+        if not target:
+            continue
+
+        full_name, _, interval = target.partition(':')
+        owner, _, repo = full_name.partition('/')
+        if not owner or not repo:
+            log.warning(f'Ignoring invalid scan target: {target}')
+            continue
+
+        scan_targets.append((owner, repo, int(interval) if interval else default_interval))
+
+    return scan_targets
+
+
+def create_scheduler(scan_targets, scheduler_class=BlockingScheduler, max_parallel=SCAN_MAX_PARALLEL,
+                     jitter=SCAN_JITTER):
+    """Create a scheduler with a scan job for every target."""
+    scheduler = scheduler_class(executors={'default': ThreadPoolExecutor(max_parallel)},
+                                job_defaults={'max_instances': 1, 'coalesce': True})
+
+    now = datetime.datetime.now()
+    for owner, repo, interval in scan_targets:
+        scheduler.add_job(run_in_lane, IntervalTrigger(seconds=interval, jitter=jitter),
+                          args=(BACKGROUND, run_conversation_check_scan_for_prs, owner, repo), id=f'{owner}/{repo}', name=f'Conversation scan of {owner}/{repo}',
+                          # Spread the first scans over the interval as well.
+                          next_run_time=now + datetime.timedelta(seconds=random.uniform(0, interval)))
+
+    return scheduler
+
 
 def main():
-    while True:
-        run_conversation_check_scan_for_prs('li-foundation', 'zac-test-repo')
-        time.sleep(10)
+    scan_targets = load_scan_targets()
+    log.info(f'Scanning {len(scan_targets)} repos, at most {SCAN_MAX_PARALLEL} at a time.')
+    create_scheduler(scan_targets).start()
 
 
 if __name__ == '__main__':
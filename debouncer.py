@@ -0,0 +1,104 @@
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from bot_config import DEBOUNCE_DELAY, DEBOUNCE_MAX_WAIT
+from priority import current_lane, ensure_thread, rank, run_in_lane
+from work_queue import submit
+
+log = logging.getLogger(__name__)
+
+"""
+DEBOUNCER
+==========
+Collapses bursts of calls for the same key (e.g. a review with a dozen comments
+all asking for the same check on the same PR) into a single call.
+
+A debounced call runs once DEBOUNCE_DELAY seconds pass without another call for
+its key, but no later than DEBOUNCE_MAX_WAIT seconds after the first one, with
+the arguments of the latest call. Due calls are handed to the work queue, in
+the most urgent lane of the calls collapsed into them.
+"""
+
+# key -> dict(func, args, lane, first_at, due_at)
+_pending = {}
+_condition = threading.Condition()
+_counters = collections.Counter()
+_thread = None
+
+
+def debounce(key, func, *args, delay=DEBOUNCE_DELAY, max_wait=DEBOUNCE_MAX_WAIT):
+    """Schedule `func(*args)` for the key, replacing a call still pending for it. Return True if one was replaced."""
+    if delay <= 0:
+        _run_calls([dict(func=func, args=args, lane=current_lane())])
+        return False
+
+    now = time.monotonic()
+    with _condition:
+        previous = _pending.get(key)
+        first_at = previous['first_at'] if previous else now
+        lane = min(previous['lane'], current_lane(), key=rank) if previous else current_lane()
+        _pending[key] = dict(func=func, args=args, lane=lane, first_at=first_at,
+                             due_at=min(now + delay, first_at + max_wait))
+        _counters['coalesced' if previous else 'scheduled'] += 1
+
+        _start_thread()
+        _condition.notify()
+
+    return previous is not None
+
+
+def run_pending():
+    """Hand every pending call to the work queue now, e.g. before shutting down."""
+    with _condition:
+        calls = list(_pending.values())
+        _pending.clear()
+        _counters['run'] += len(calls)
+
+    _run_calls(calls)
+
+
+def debounce_stats():
+    """Return how many calls are pending and how many were scheduled, coalesced and run."""
+    with _condition:
+        stats = dict(_counters)
+        stats['pending'] = len(_pending)
+    return stats
+
+
+def _start_thread():
+    global _thread
+
+    _thread = ensure_thread(_thread, 'debouncer', _run_due_calls)
+
+
+def _run_due_calls():
+    while True:
+        with _condition:
+            now = time.monotonic()
+            due_keys = [key for key, call in _pending.items() if call['due_at'] <= now]
+            if not due_keys:
+                next_due_at = min((call['due_at'] for call in _pending.values()), default=None)
+                _condition.wait(None if next_due_at is None else next_due_at - now)
+                continue
+
+            due_calls = [_pending.pop(key) for key in due_keys]
+            _counters['run'] += len(due_calls)
+
+        _run_calls(due_calls)
+
+
+def _run_calls(calls):
+    for call in calls:
+        if submit(call['func'], *call['args'], lane=call['lane']):
+            continue
+
+        # The work queue is full, run it here rather than lose it.
+        try:
+            run_in_lane(call['lane'], call['func'], *call['args'])
+        except Exception:
+            log.error(f'Debounced call {getattr(call["func"], "__name__", call["func"])} failed.')
+            traceback.print_exc(file=sys.stderr)
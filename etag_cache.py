@@ -0,0 +1,66 @@
+import collections
+import threading
+
+from bot_config import GH_ETAG_CACHE_BYTES, GH_ETAG_CACHE_ENTRIES
+
+"""
+ETAG CACHE
+===========
+Keeps the last response of REST GETs that came with an `ETag`, keyed by URL and
+installation, so the next GET of the same resource can be conditional. GitHub
+answers `304 Not Modified` (which does not count against the rate limit) when
+nothing changed, and the cached response is used instead.
+
+The least recently used responses are dropped once the cache holds more than
+GH_ETAG_CACHE_ENTRIES responses or GH_ETAG_CACHE_BYTES bytes of bodies.
+"""
+
+# key -> (etag, response)
+_responses = collections.OrderedDict()
+_lock = threading.Lock()
+_counters = collections.Counter()
+_size = 0
+
+
+def conditional_headers(key):
+    """Return the `If-None-Match` header to send for the key, if its response is cached."""
+    with _lock:
+        cached = _responses.get(key)
+    return {'If-None-Match': cached[0]} if cached else {}
+
+
+def resolve(key, response):
+    """Return the cached response if GitHub answered 304, otherwise cache the response if it has an ETag and return it."""
+    global _size
+
+    with _lock:
+        if response.status_code == 304 and key in _responses:
+            _responses.move_to_end(key)
+            _counters['hits'] += 1
+            return _responses[key][1]
+
+        _counters['misses'] += 1
+        etag = response.headers.get('ETag')
+        if response.status_code != 200 or not etag or len(response.content) > GH_ETAG_CACHE_BYTES:
+            return response
+
+        if key in _responses:
+            _size -= len(_responses.pop(key)[1].content)
+        _responses[key] = (etag, response)
+        _size += len(response.content)
+
+        while _size > GH_ETAG_CACHE_BYTES or len(_responses) > GH_ETAG_CACHE_ENTRIES:
+            _, (_, evicted) = _responses.popitem(last=False)
+            _size -= len(evicted.content)
+            _counters['evictions'] += 1
+
+    return response
+
+
+def cache_stats():
+    """Return the hits, misses and evictions of the cache and how much it holds."""
+    with _lock:
+        stats = dict(_counters)
+        stats['entries'] = len(_responses)
+        stats['bytes'] = _size
+    return stats
@@ -0,0 +1,98 @@
+from policies import POLICIES
+
+"""
+EVENT ROUTER
+=============
+Which policies (see policies.py) are evaluated for which webhook event. The
+rules below are compiled into lookup tables once at import time, so routing a
+delivery is a dict lookup, and a policy listed by several matching rules is
+still evaluated only once per delivery. Every policy is evaluated again when its
+check run is re-requested.
+
+To add a policy, register it in policies.py and add its check name to the rules.
+
+Policies in DEBOUNCED_POLICIES don't run right away: a burst of events asking
+for them on the same PR is collapsed into one run with the latest event.
+
+For the events in SHA_DETERMINED_EVENTS a policy runs once per PR head SHA.
+
+Deliveries of RERUN_EVENTS run in the rerun lane, the others in the interactive
+lane (see priority.py).
+"""
+
+ANY_ACTION = '*'
+
+# (event type, actions the policy cares about or ANY_ACTION, check name of the policy), in the order they run
+EVENT_RULES = [
+    ('pull_request', ('opened', 'synchronize'), 'Multiproduct Trunk Status'),
+    ('pull_request', ('opened', 'edited', 'synchronize'), 'PR Basic Information Check'),
+    ('pull_request', ('opened', 'synchronize'), 'Conversation Resolution'),
+    ('pull_request_review_comment', ANY_ACTION, 'Conversation Resolution'),
+    ('pull_request_review', ANY_ACTION, 'Conversation Resolution'),
+    ('issue_comment', ('created',), 'Conversation Resolution'),
+]
+
+
+# Policies that are debounced per (repo, PR, policy)
+DEBOUNCED_POLICIES = frozenset([
+    'Conversation Resolution',
+])
+
+
+# Events after which the policies' results only depend on the PR head SHA, so they run once per head SHA
+SHA_DETERMINED_EVENTS = frozenset([
+    ('pull_request', 'opened'),
+    ('pull_request', 'synchronize'),
+])
+
+
+# Events asking for checks to run again, rather than reacting to a developer's action
+RERUN_EVENTS = frozenset([
+    ('check_run', 'rerequested'),
+])
+
+
+def compile_routes(event_rules, policy_names):
+    """Turn the rules into a {(event type, action): policy names} table.
+
+    Re-requested check runs are routed by check name, under ('check_run', 'rerequested', name).
+    """
+    unknown = {name for _, _, name in event_rules} - set(policy_names)
+    if unknown:
+        raise ValueError(f'Events are routed to unknown policies: {sorted(unknown)}')
+
+    routes = {}
+    for event_type, actions, name in event_rules:
+        for action in ((ANY_ACTION,) if actions == ANY_ACTION else actions):
+            routes.setdefault((event_type, action), [])
+
+    for event_type, actions, name in event_rules:
+        for key in routes:
+            if key[0] == event_type and (actions == ANY_ACTION or key[1] in actions) and name not in routes[key]:
+                routes[key].append(name)
+
+    for name in policy_names:
+        routes[('check_run', 'rerequested', name)] = [name]
+
+    return {key: tuple(names) for key, names in routes.items()}
+
+
+_routes = compile_routes(EVENT_RULES, POLICIES)
+HANDLED_EVENTS = frozenset(key[0] for key in _routes)
+_handled_actions = {event_type: frozenset(key[1] for key in _routes if key[0] == event_type)
+                    for event_type in HANDLED_EVENTS}
+
+
+def handles(event_type, action=None):
+    """Tell whether any policy runs for the event type (and action, if given), before decoding its payload."""
+    if action is None:
+        return event_type in HANDLED_EVENTS
+    return action in _handled_actions.get(event_type, ()) or ANY_ACTION in _handled_actions.get(event_type, ())
+
+
+def route(event_type, action, check_run_name=None):
+    """Return the names of the policies to evaluate for an event, each one once."""
+    if event_type == 'check_run':
+        return _routes.get((event_type, action, check_run_name), ())
+
+    return _routes.get((event_type, action)) or _routes.get((event_type, ANY_ACTION), ())
@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import functools
+import os
+import priority
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from bot_config import API_BASE_URL, GH_ASYNC_MAX_IN_FLIGHT, GH_ASYNC_PER_HOST, GH_ASYNC_PER_INSTALLATION, \
+    GQL_API_URL
+from gh_session import CORE, GRAPHQL, quota_delay
+from gh_utils import make_github_api_call, make_github_gql_api_call, set_check_on_pr
+
+"""
+ASYNC GITHUB CLIENT
+====================
+asyncio flavoured GitHub calls, so independent calls can be awaited together
+(e.g. with `asyncio.gather`) instead of one after the other.
+
+The calls still go through the blocking client in gh_utils, and with it through
+the pooled session, retries, rate limit pacing, ETag cache and token cache. They
+run on a shared pool of GH_ASYNC_MAX_IN_FLIGHT threads, while process wide
+limits keep at most GH_ASYNC_PER_INSTALLATION calls in flight per installation
+and GH_ASYNC_PER_HOST per host, across every event loop (each `run` has its
+own). A call waits for its slots on its event loop before it is handed to the
+pool, so waiting calls hold neither pool threads nor, while they wait for their
+installation, host slots: a busy installation does not hold up the others.
+Synchronous code keeps calling gh_utils, or uses `run_concurrently` to fan out
+a few calls.
+
+Calls run in the priority lane of the code awaiting them; a call waiting for
+rate limit quota (see gh_session) waits before taking a slot, so it does not
+hold up the calls of more urgent lanes.
+"""
+
+REST_HOST = urlsplit(str(API_BASE_URL)).netloc
+GQL_HOST = urlsplit(GQL_API_URL).netloc
+
+_executor = None
+_executor_lock = threading.Lock()
+# (kind, name) -> _Limit bounding the calls in flight for it
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+class _Limit:
+    """A semaphore shared by every thread and event loop, whose waiters yield to their own event loop."""
+
+    def __init__(self, limit):
+        self._lock = threading.Lock()
+        self._available = limit
+        # (loop, future) of the callers waiting for a slot, first come first served
+        self._waiters = collections.deque()
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._available and not self._waiters:
+                self._available -= 1
+                return
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if (loop, future) in self._waiters:
+                    self._waiters.remove((loop, future))
+                    raise
+            # The slot was handed over already, pass it on.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        """Hand the slot over to the first caller waiting for one, or give it back."""
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, future)
+                    return
+                except RuntimeError:
+                    # Its event loop is closed, it waits no more.
+                    continue
+            self._available += 1
+
+    def _hand_over(self, future):
+        if future.done():
+            # Its waiter was cancelled meanwhile.
+            self.release()
+        else:
+            future.set_result(None)
+
+
+async def call(func, *args, host=REST_HOST, resource=CORE, installation_id=None, **kwargs):
+    """Run a blocking GitHub function on the pool, within the host and installation limits.
+
+    `resource` is the rate limit its calls count against (see gh_session).
+    """
+    loop = asyncio.get_running_loop()
+    lane = priority.current_lane()
+    delay = quota_delay(host, lane, resource)
+    while delay:
+        await asyncio.sleep(delay)
+        delay = quota_delay(host, lane, resource)
+
+    # The installation first: a call waiting for a busy installation does not hold a slot of the host.
+    async with _limit('installation', str(installation_id), GH_ASYNC_PER_INSTALLATION):
+        async with _limit('host', host, GH_ASYNC_PER_HOST):
+            return await loop.run_in_executor(_get_executor(),
+                                              functools.partial(priority.run_in_lane, lane, func, *args, **kwargs))
+
+
+async def make_github_api_call_async(api_path, method='GET', params=None, installation_id=None):
+    """Async `gh_utils.make_github_api_call`."""
+    return await call(make_github_api_call, api_path, method, params, installation_id,
+                      installation_id=installation_id)
+
+
+async def make_github_gql_api_call_async(query, installation_id=None):
+    """Async `gh_utils.make_github_gql_api_call`."""
+    return await call(make_github_gql_api_call, query, installation_id, host=GQL_HOST, resource=GRAPHQL,
+                      installation_id=installation_id)
+
+
+async def set_check_on_pr_async(repo_full_name, check_name, check_status, check_conclusion, head_sha,
+                                output_title=None, output_summary=None, installation_id=None, check_run_id=None):
+    """Async `gh_utils.set_check_on_pr`."""
+    return await call(set_check_on_pr, repo_full_name, check_name, check_status, check_conclusion, head_sha,
+                      output_title, output_summary, installation_id, check_run_id, installation_id=installation_id)
+
+
+def run(coroutine):
+    """Run a coroutine to completion from synchronous code (not from within a running event loop)."""
+    return asyncio.run(coroutine)
+
+
+def run_concurrently(*funcs, host=REST_HOST, resource=CORE, installation_id=None, return_exceptions=False):
+    """Run blocking GitHub functions taking no arguments concurrently, and return their results in order.
+
+    The first exception raised is raised again, or with `return_exceptions` returned in place of the result.
+    """
+    async def gather():
+        return await asyncio.gather(*(call(func, host=host, resource=resource, installation_id=installation_id)
+                                      for func in funcs), return_exceptions=return_exceptions)
+
+    return run(gather())
+
+
+def _limit(kind, name, limit):
+    with _limits_lock:
+        if (kind, name) not in _limits:
+            _limits[(kind, name)] = _Limit(limit)
+        return _limits[(kind, name)]
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(GH_ASYNC_MAX_IN_FLIGHT, thread_name_prefix='gh-async')
+    return _executor
+
+
+def _reset_after_fork():
+    global _executor, _limits, _limits_lock
+
+    # The pool's threads don't survive a fork, the child creates its own pool, and its own limits as the
+    # slots the parent's calls held are never given back.
+    _executor = None
+    _limits = {}
+    _limits_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
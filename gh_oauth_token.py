@@ -1,15 +1,24 @@
+import calendar
 import datetime
 import json
 import jwt
 import logging
+import metrics
 import os
-import requests
+import shared_store
 import sys
+import tempfile
+import threading
 import time
 import traceback
 import uuid
 
-from bot_config import API_BASE_URL
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from bot_config import API_BASE_URL, GH_APP_ID
+from gh_session import request
+from priority import ensure_thread
 
 log = logging.getLogger(__name__)
 
@@ -27,31 +36,27 @@ authentication and authorization w/ GitHub.
 _token_storage_path = f'private/.secret'
 _private_key_path = f'private/gh-app.key'
 
+# (mtime, key) of the last loaded private key, and app_id -> (jwt, exp, key) of the last signed JWTs
+_private_key = None
+_app_jwts = {}
+_app_jwt_lock = threading.Lock()
+# Sign a new JWT once the cached one expires in less than this many seconds
+_APP_JWT_REUSE_MARGIN = 60
+
 
 def get_token(app_id, installation_id):
     """Get a token from GitHub."""
     token_url = f"{API_BASE_URL}/app/installations/{installation_id}/access_tokens"
-    temp_state = str(uuid.uuid4())
-    private_key = get_private_key()
-
-    # Required params.
-    params = {
-        'iat': int(time.time()),
-        'exp': int(time.time() + 500),
-        'iss': app_id,
-        'state': temp_state
-    }
 
     try:
-        # Create a Json Web Token object with the required params.
-        encoded = jwt.encode(params, private_key,
-                             algorithm='RS256').decode("utf-8")
+        encoded = get_app_jwt(app_id)
         headers = {'Accept': 'application/vnd.github.machine-man-preview+json',
                    'Authorization': f'Bearer {encoded}'  # OAuth 2.0
                    }
 
         # Send request to GitHub.
-        response = requests.post(token_url, headers=headers)
+        # Minting a second token does no harm, a failed mint can be retried.
+        response = request('POST', token_url, headers=headers, idempotent=True)
 
     except Exception as exc:
         log.error(f"Could get token for App - {app_id}", exc)
@@ -67,16 +72,15 @@ def get_token(app_id, installation_id):
 
 
 def store_token(token_json):
+    """Cache a token returned by `get_token` and make its installation the default one."""
     if token_json:
         try:
-            if os.path.exists(_token_storage_path):
-                os.unlink(_token_storage_path)
-
-            with open(_token_storage_path, 'w') as secret_file:
-                secret_file.write(json.dumps(token_json))
+            entry = _cache_token(token_json, make_default=True)
+            _persist_tokens()
+            return entry
 
         except Exception as exc:
-            log.error(f'Could not write secret file.\n{exc}')
+            log.error(f'Could not store token.\n{exc}')
             traceback.print_exc(file=sys.stderr)
 
     else:
@@ -84,72 +88,313 @@ def store_token(token_json):
 
 
 def peek_app_token():
-    """Peek on secret file that has the token, deserialize it and return the dict."""
+    """Peek on secret file that has the tokens, deserialize it and return the list of token dicts."""
+    if shared_store.enabled():
+        return _peek_shared_tokens()
+
     if not os.path.exists(_token_storage_path):
-        return '{}'
+        return []
 
     try:
         with open(_token_storage_path) as secret_file:
-            return json.loads(secret_file.read())
+            stored = json.loads(secret_file.read())
+
+        # Older versions stored a single JSON encoded token.
+        if isinstance(stored, str):
+            stored = [json.loads(stored)]
+        return [token for token in stored if isinstance(token, dict)]
 
     except Exception as exc:
         log.error(f'Could not read secret file.\n{exc}')
         traceback.print_exc(file=sys.stderr)
+        return []
+
+
+def refresh_token(app_id=None, installation_id=None):
+    """Refresh the token of an installation (the default one if not given) and return it."""
+    key = _resolve_key(app_id, installation_id)
+    if key is None:
+        log.error('Could not refresh token, no installation is known yet.')
+        return None
+
+    with _refresh_lock_for(key):
+        # Someone else (or another process) may have refreshed it while we were waiting for the lock.
+        entry = _tokens.get(key)
+        if shared_store.enabled():
+            entry = _load_shared_token(key) or entry
+        if entry and entry['expires_at'] > time.time() + _EXPIRY_BUFFER + _REFRESH_AHEAD:
+            return entry['token']
+
+        try:
+            entry = _cache_token(get_token(*key))
+            _persist_tokens()
+            return entry['token']
+
+        except Exception as exc:
+            log.error(f'Could not refresh token.\n{exc}')
+            traceback.print_exc(file=sys.stderr)
+
+    # Keep using the old token as long as it is still valid.
+    if entry and entry['expires_at'] > time.time():
+        return entry['token']
+    return None
+
+
+@metrics.timed('bot_token_retrieve_duration_seconds')
+def retrieve_token(app_id=None, installation_id=None):
+    """Retrieve latest token of an installation (the default one if not given). If expired, refresh it."""
+    key = _resolve_key(app_id, installation_id)
+    if key is None:
+        log.error('Could not retrieve token, no installation is known yet.')
+        return None
+
+    entry = _tokens.get(key)
+    # Token is good, return it
+    if entry and entry['expires_at'] > time.time() + _EXPIRY_BUFFER:
+        return entry['token']
+
+    return refresh_token(*key)
+
+
+"""
+TOKEN CACHE
+============
+Tokens live in a process wide dict keyed by (app_id, installation_id), with the
+expiry already parsed, so retrieving one is a dict lookup. A background thread
+refreshes them a while before they run into the expiry buffer, and concurrent
+refreshes of one installation collapse into a single call to GitHub. The secret
+file is only written (atomically) so tokens survive a restart.
+
+With a shared store (SHARED_STATE_PATH) the tokens are kept there instead of in
+the secret file, so the processes of the bot share them: a process about to
+refresh a token first takes the one another process may have stored meanwhile.
+"""
+
+# A token is not handed out anymore once it expires in less than this many seconds
+_EXPIRY_BUFFER = 300
+# The background refresher renews tokens this many seconds before they reach the buffer
+_REFRESH_AHEAD = 300
+_REFRESH_CHECK_INTERVAL = 60
+
+_tokens = {}
+_default_key = None
+_loaded = False
+_cache_lock = threading.Lock()
+_load_lock = threading.Lock()
+_refresh_locks = {}
+_refresher = None
+
+# Namespaces of the shared store holding the tokens by `app_id/installation_id`, and the default installation
+_SHARED_TOKENS = 'installation_tokens'
+_SHARED_DEFAULT = 'default_installation'
+
+
+def _cache_token(token_json, make_default=False):
+    global _default_key
+
+    token = json.loads(token_json) if isinstance(token_json, str) else dict(token_json)
+    if not token.get('token') or not token.get('expires_at'):
+        raise ValueError(f'Token response has no token: {token.get("message", token)}')
+
+    key = (str(token.get('app_id')), str(token.get('installation_id')))
+    entry = dict(token=token['token'], expires_at=_parse_expiry(token['expires_at']), raw=token)
+
+    with _cache_lock:
+        _tokens[key] = entry
+        if make_default or _default_key is None:
+            _default_key = key
+
+    _start_refresher()
+    return entry
+
+
+def _resolve_key(app_id, installation_id):
+    global _default_key
+
+    _load_persisted_tokens()
+
+    if installation_id is None:
+        if _default_key is None and shared_store.enabled():
+            # Another process may have been authenticated since the tokens were loaded.
+            default_key = _get_shared(_SHARED_DEFAULT, 'key')
+            _default_key = tuple(default_key) if default_key else None
+        return _default_key
+
+    if app_id is None:
+        app_id = _default_key[0] if _default_key else GH_APP_ID
+    return str(app_id), str(installation_id)
+
+
+def _load_persisted_tokens():
+    global _loaded
+
+    if _loaded:
+        return
+
+    with _load_lock:
+        if _loaded:
+            return
+
+        for token in peek_app_token():
+            try:
+                _cache_token(token)
+            except Exception as exc:
+                log.warning(f'Ignoring stored token.\n{exc}')
+
+        _loaded = True
+
+
+def _persist_tokens():
+    with _cache_lock:
+        tokens = [entry['raw'] for entry in _tokens.values()]
+        default_key = _default_key
 
+    if shared_store.enabled():
+        _persist_shared_tokens(tokens, default_key)
+        return
 
-def refresh_token():
-    """Refresh tokens of an individual app."""
     try:
-        deserialized_message = json.loads(peek_app_token())
-        app_id = deserialized_message.get('app_id')
-        installation_id = deserialized_message.get('installation_id')
-        store_token(get_token(app_id, installation_id))
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(_token_storage_path) or '.', prefix='.secret.')
+        with os.fdopen(fd, 'w') as secret_file:
+            secret_file.write(json.dumps(tokens))
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, _token_storage_path)
 
     except Exception as exc:
-        log.error(f'Could not refresh token.\n{exc}')
+        log.error(f'Could not write secret file.\n{exc}')
         traceback.print_exc(file=sys.stderr)
 
 
-def retrieve_token():
-    """Retrieve latest token. If expired, refresh it."""
+def _peek_shared_tokens():
+    stored = _get_shared(_SHARED_TOKENS) or {}
+    # The default installation goes first, so it stays the default one when the tokens are loaded.
+    default_key = _get_shared(_SHARED_DEFAULT, 'key')
+    default_name = '/'.join(default_key) if default_key else None
+    return sorted(stored.values(), key=lambda token: _shared_name(token) != default_name)
+
+
+def _load_shared_token(key):
+    token = _get_shared(_SHARED_TOKENS, '/'.join(key))
+    if not token:
+        return None
+
     try:
-        deserialized_message = json.loads(peek_app_token())
-
-        expires_at = deserialized_message.get('expires_at')
-        # Token is good, return it
-        if expires_at and check_expired_time(expires_at):
-            return deserialized_message.get('token')
-        else:  # Token expired, refresh it
-            refresh_token()
-
-            deserialized_message = json.loads(peek_app_token())
-            expires_at = deserialized_message.get('expires_at')
-            # Token is good, return it
-            try:
-                assert(expires_at and check_expired_time(expires_at))
-                return deserialized_message.get('token')
-            except:
-                raise  # When all else fails
+        return _cache_token(token)
+    except Exception as exc:
+        log.warning(f'Ignoring stored token.\n{exc}')
+        return None
+
+
+def _persist_shared_tokens(tokens, default_key):
+    try:
+        for token in tokens:
+            shared_store.put(_SHARED_TOKENS, _shared_name(token), token, expires_at=_parse_expiry(token['expires_at']))
+        if default_key:
+            shared_store.put(_SHARED_DEFAULT, 'key', list(default_key))
 
     except Exception as exc:
-        log.error(f'Could not refresh token.\n{exc}')
+        log.error(f'Could not write tokens to the shared store.\n{exc}')
         traceback.print_exc(file=sys.stderr)
 
-    return None
+
+def _get_shared(namespace, key=None):
+    """Return a value (or with no key, every value) of the shared store, None if it can't be read."""
+    try:
+        return shared_store.get(namespace, key) if key else shared_store.items(namespace)
+    except Exception as exc:
+        log.error(f'Could not read the shared store.\n{exc}')
+        traceback.print_exc(file=sys.stderr)
+        return None
+
+
+def _shared_name(token):
+    return f'{token.get("app_id")}/{token.get("installation_id")}'
+
+
+def _refresh_lock_for(key):
+    with _cache_lock:
+        return _refresh_locks.setdefault(key, threading.Lock())
+
+
+def _start_refresher():
+    global _refresher
+
+    with _cache_lock:
+        _refresher = ensure_thread(_refresher, 'token-refresher', _refresh_loop)
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(_REFRESH_CHECK_INTERVAL)
+
+        with _cache_lock:
+            expiring = [key for key, entry in _tokens.items()
+                        if entry['expires_at'] <= time.time() + _EXPIRY_BUFFER + _REFRESH_AHEAD]
+
+        for key in expiring:
+            refresh_token(*key)
+
+
+def _parse_expiry(date_time_str):
+    """Turn an `expires_at` string ("2019-09-16T19:04:13Z") into epoch seconds."""
+    return calendar.timegm(time.strptime(date_time_str, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def get_app_jwt(app_id):
+    """Return a signed JWT for the app, reusing the last one until shortly before it expires."""
+    now = time.time()
+    private_key = get_private_key()
+
+    with _app_jwt_lock:
+        cached = _app_jwts.get(str(app_id))
+        # A reloaded key object means the key file changed, so the old JWT is not reused.
+        if cached and cached[1] > now + _APP_JWT_REUSE_MARGIN and cached[2] is private_key:
+            return cached[0]
+
+    # Required params.
+    params = {
+        'iat': int(now),
+        'exp': int(now + 500),
+        'iss': app_id,
+        'state': str(uuid.uuid4())
+    }
+
+    # Create a Json Web Token object with the required params.
+    encoded = jwt.encode(params, private_key, algorithm='RS256')
+    if isinstance(encoded, bytes):
+        encoded = encoded.decode("utf-8")
+
+    with _app_jwt_lock:
+        _app_jwts[str(app_id)] = (encoded, params['exp'], private_key)
+
+    return encoded
 
 
 def get_private_key():
-    """Read private key from hidden file and return it."""
-    if not os.path.exists(_private_key_path):
+    """Return the parsed private key, reading the hidden file again only when it changes."""
+    global _private_key
+
+    try:
+        mtime = os.stat(_private_key_path).st_mtime
+    except FileNotFoundError:
         return None
 
+    cached = _private_key
+    if cached and cached[0] == mtime:
+        return cached[1]
+
     try:
-        with open(_private_key_path) as secret_file:
-            return secret_file.read()
+        with open(_private_key_path, 'rb') as secret_file:
+            private_key = serialization.load_pem_private_key(secret_file.read(), password=None,
+                                                             backend=default_backend())
 
     except Exception as exc:
         log.error(f'Could not read private key.\n{exc}')
         traceback.print_exc(file=sys.stderr)
+        return None
+
+    _private_key = (mtime, private_key)
+    return private_key
 
 
 def check_expired_time(date_time_str, date_time_format=None, buffer=300):
@@ -0,0 +1,266 @@
+import logging
+import metrics
+import priority
+import re
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from bot_config import GH_ASYNC_PER_HOST, GH_HTTP_BACKOFF, GH_HTTP_MAX_RETRIES, GH_HTTP_POOL_SIZE, \
+    GH_HTTP_TIMEOUT, GH_INTERACTIVE_MAX_QUOTA_WAIT, GH_RATE_LIMIT_RESERVE
+
+log = logging.getLogger(__name__)
+
+"""
+GITHUB HTTP SESSION
+====================
+Every call to GitHub goes through one shared `requests.Session`, so connections
+(and their TLS handshakes) are reused across calls and threads.
+
+On top of connection pooling this module
+- retries 5xx responses and secondary rate limits with exponential backoff
+  (5xx responses and connection errors after the request went out only for
+  calls that are safe to send twice, so e.g. a check run is not created twice),
+- remembers the `X-RateLimit-*` headers of each host and rate limit resource
+  (`core` for REST and `graphql`, which GitHub counts apart even on one host),
+  so once the remaining quota gets low the calls are spread over the rest of
+  the window instead of running into 403s, and the calls of reruns and
+  background scans wait for the window to reset while the quota is within the
+  share kept for more urgent lanes, and
+- observes how long each call takes (retries included) per endpoint and status.
+"""
+
+_RETRY_STATUSES = {500, 502, 503, 504}
+# Methods a call can be sent twice with, should GitHub have handled the first one before failing (the bot's
+# PATCHes set fields to given values, so sending one again changes nothing)
+_IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'DELETE'}
+
+# Seconds between looks at the rate limit while a call waits for quota left to more urgent lanes
+_QUOTA_RECHECK_INTERVAL = 5.0
+
+# Turn a URL path into the endpoint it calls, e.g. /api/v3/repos/o/r/pulls/1 into /repos/{owner}/{repo}/pulls/{id}
+_ENDPOINT_PATTERNS = [
+    (re.compile(r'^/api(/v3)?(?=/)'), ''),
+    (re.compile(r'^/repos/[^/]+/[^/]+'), '/repos/{owner}/{repo}'),
+    (re.compile(r'/[0-9a-f]{40}(?=/|$)'), '/{sha}'),
+    (re.compile(r'/\d+(?=/|$)'), '/{id}'),
+]
+
+_session = None
+_session_lock = threading.Lock()
+
+# Rate limit resources of REST and GraphQL calls, as in GitHub's X-RateLimit-Resource header
+CORE = 'core'
+GRAPHQL = 'graphql'
+
+# (host, resource) -> {'limit': int, 'remaining': int, 'reset': epoch seconds}
+_rate_limits = {}
+_rate_limits_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process wide session, creating it on first use."""
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # Room for the calls of the async client (see gh_async) on top of the synchronous ones, so
+                # connections are kept alive rather than dropped when the pool is full.
+                adapter = HTTPAdapter(pool_connections=GH_HTTP_POOL_SIZE,
+                                      pool_maxsize=GH_HTTP_POOL_SIZE + GH_ASYNC_PER_HOST)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+
+    return _session
+
+
+def request(method, url, resource=CORE, idempotent=None, **kwargs):
+    """Send a request to GitHub, throttling and retrying as needed, and return the final response.
+
+    `resource` is the rate limit the call counts against (CORE or GRAPHQL). `idempotent` tells whether the call
+    may be sent twice (e.g. a GraphQL query), by default whether its method is idempotent.
+    """
+    start = time.perf_counter()
+    status = 'error'
+    if idempotent is None:
+        idempotent = method.upper() in _IDEMPOTENT_METHODS
+    try:
+        response = _request(method, url, resource, idempotent, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        metrics.observe('bot_github_call_duration_seconds', time.perf_counter() - start, method=method,
+                        endpoint=endpoint(url), status=status)
+
+
+def endpoint(url):
+    """Return the endpoint a URL calls, with the owner, repo, SHAs and numbers in its path replaced."""
+    path = urlsplit(url).path
+    for pattern, replacement in _ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path
+
+
+def _request(method, url, resource, idempotent, **kwargs):
+    host = urlsplit(url).netloc
+    kwargs.setdefault('timeout', GH_HTTP_TIMEOUT)
+
+    wait_for_quota(host, resource)
+
+    attempt = 0
+    while True:
+        _throttle(host, resource)
+
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except requests.ConnectionError as exc:
+            if attempt >= GH_HTTP_MAX_RETRIES or not (idempotent or _nothing_sent(exc)):
+                raise
+            attempt += 1
+            delay = _backoff(attempt)
+            log.warning(f'Connection to {host} failed, retrying in {delay:.1f}s ({attempt}/{GH_HTTP_MAX_RETRIES})')
+            time.sleep(delay)
+            continue
+
+        _record_rate_limit(host, resource, response)
+
+        delay = _retry_delay(response, attempt, idempotent)
+        if delay is None or attempt >= GH_HTTP_MAX_RETRIES:
+            return response
+
+        attempt += 1
+        log.warning(f'{method} {urlsplit(url).path} returned {response.status_code}, '
+                    f'retrying in {delay:.1f}s ({attempt}/{GH_HTTP_MAX_RETRIES})')
+        time.sleep(delay)
+
+
+def rate_limit_status():
+    """Return the last seen rate limit state of each (host, resource)."""
+    with _rate_limits_lock:
+        return {key: dict(state) for key, state in _rate_limits.items()}
+
+
+def quota_delay(host, lane, resource=CORE):
+    """Return how long a call of the lane should wait before looking at the rate limit again, 0 to go ahead."""
+    reserve = priority.QUOTA_RESERVES[lane]
+    if not reserve:
+        return 0
+
+    with _rate_limits_lock:
+        state = _rate_limits.get((host, resource))
+        if not state or state['remaining'] > reserve * state['limit']:
+            return 0
+        window_left = state['reset'] - time.time()
+
+    # Once the window reset, _throttle forgets its state.
+    return min(window_left, _QUOTA_RECHECK_INTERVAL) if window_left > 0 else 0
+
+
+def wait_for_quota(host, resource=CORE):
+    """Sleep while the rate limit of the host is within the share the lane of the caller leaves to others."""
+    lane = priority.current_lane()
+    delay = quota_delay(host, lane, resource)
+    if not delay:
+        return
+
+    log.info(f'{resource} rate limit for {host} is kept for more urgent work, {lane} call waiting')
+    start = time.perf_counter()
+    while delay:
+        time.sleep(delay)
+        delay = quota_delay(host, lane, resource)
+    metrics.observe('bot_quota_wait_duration_seconds', time.perf_counter() - start, lane=lane)
+
+
+def _backoff(attempt):
+    return GH_HTTP_BACKOFF * (2 ** (attempt - 1))
+
+
+def _nothing_sent(error):
+    """Tell whether a connection error happened before the request went out, e.g. the connection was refused."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+
+
+def _retry_delay(response, attempt, idempotent=True):
+    """Return how long to wait before retrying the response, or None if it should not be retried."""
+    if response.status_code in _RETRY_STATUSES:
+        # GitHub may have handled the call before failing.
+        return _backoff(attempt + 1) if idempotent else None
+
+    if response.status_code not in (403, 429):
+        return None
+
+    # Secondary rate limits come with a Retry-After header (or at least say so in the message).
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+
+    if 'secondary rate limit' in response.text.lower() or 'abuse' in response.text.lower():
+        return max(_backoff(attempt + 1), 60.0)
+
+    # Primary rate limit exhausted, wait for the window to reset (unless that holds up interactive work too long).
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        reset = response.headers.get('X-RateLimit-Reset', '')
+        if reset.isdigit():
+            delay = max(int(reset) - time.time(), 0) + 1
+            return None if _too_long_for_interactive(delay) else delay
+
+    return None
+
+
+def _record_rate_limit(host, resource, response):
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    reset = response.headers.get('X-RateLimit-Reset')
+    if remaining is None or reset is None:
+        return
+
+    try:
+        state = {
+            'limit': int(response.headers.get('X-RateLimit-Limit', 0)),
+            'remaining': int(remaining),
+            'reset': int(reset),
+        }
+    except ValueError:
+        return
+
+    # GitHub says which limit it counted the call against, the caller's guess is only the fallback.
+    key = (host, response.headers.get('X-RateLimit-Resource') or resource)
+    with _rate_limits_lock:
+        _rate_limits[key] = state
+
+
+def _throttle(host, resource):
+    """Sleep if the host is close to its rate limit, spreading the remaining calls over the window."""
+    with _rate_limits_lock:
+        state = _rate_limits.get((host, resource))
+        if not state or state['remaining'] > GH_RATE_LIMIT_RESERVE:
+            return
+
+        window_left = state['reset'] - time.time()
+        if window_left <= 0:
+            del _rate_limits[(host, resource)]
+            return
+
+        delay = window_left / max(state['remaining'], 1)
+        if _too_long_for_interactive(delay):
+            # Sent after a bounded wait, it fails fast if the quota is gone.
+            delay = GH_INTERACTIVE_MAX_QUOTA_WAIT
+        # Count the call we are about to make, so concurrent callers keep spacing out.
+        state['remaining'] = max(state['remaining'] - 1, 0)
+
+    log.info(f'{resource} rate limit for {host} is low ({state["remaining"]} left), waiting {delay:.1f}s')
+    time.sleep(delay)
+
+
+def _too_long_for_interactive(delay):
+    return delay > GH_INTERACTIVE_MAX_QUOTA_WAIT and priority.current_lane() == priority.INTERACTIVE
@@ -1,17 +1,23 @@
+import etag_cache
 import json
+import json_decode
 import logging
-import requests
 
 from string import Template
 from typing import Any, Mapping
 
 from gh_oauth_token import retrieve_token
-from bot_config import API_BASE_URL
+from gh_session import GRAPHQL, request
+from bot_config import API_BASE_URL, GH_PAGE_SIZE, GQL_API_URL
 
 log = logging.getLogger(__name__)
 
 
-def make_github_api_call(api_path, method='GET', params=None):
+class GitHubError(Exception):
+    """A GitHub call failed, or did not return what was asked for."""
+
+
+def make_github_api_call(api_path, method='GET', params=None, installation_id=None):
     """Send API call to Github using a personal token.
 
 Use this function to make API calls to the GitHub REST api
@@ -33,10 +39,75 @@ new_comment = make_github_rest_api_call(
         'body': "Hello there, thanks for creating a new Pull Request!"
     }
 )
+```
+
+Pass `installation_id` to call GitHub as an installation other than the default one.
+    """
+
+    try:
+        response = _send_github_api_call(f'{API_BASE_URL}/{api_path}', method, params, installation_id)
+        return json_decode.loads(response.content)
+    except Exception as e:
+        log.exception("Could not make a successful API call to GitHub.")
+
+
+def iter_github_api_pages(api_path, per_page=GH_PAGE_SIZE, installation_id=None):
+    """Yield the pages of a paginated GitHub REST list, following the `Link` header lazily.
+
+Raise GitHubError on a page GitHub answers with an error, rather than end the list early.
+
+For example, every open pull request of a repo
+---
+```py
+for page in iter_github_api_pages('repos/my_org/my_repo/pulls'):
+    for pull_request in page:
+        ...
+```
+    """
+    for response in _iter_github_api_responses(api_path, per_page, installation_id):
+        page = json_decode.loads(response.content)
+        if not isinstance(page, list):
+            raise GitHubError(f'Expected a list from {api_path}, got: {page}')
+
+        yield page
+
+
+def iter_github_api_items(api_path, per_page=GH_PAGE_SIZE, installation_id=None):
+    """Yield the items of a paginated GitHub REST list one by one, fetching pages as needed."""
+    for page in iter_github_api_pages(api_path, per_page, installation_id):
+        yield from page
+
+
+def iter_github_api_fields(api_path, fields, per_page=GH_PAGE_SIZE, installation_id=None):
+    """Yield only the given (dotted) fields of the items of a paginated GitHub REST list.
+
+For example, the SHA and message of every commit of a PR, without decoding the rest of the commits
+---
+```py
+for commit in iter_github_api_fields('repos/my_org/my_repo/pulls/31/commits', ('sha', 'commit.message')):
+    print(commit['sha'], commit['commit.message'])
 ```
     """
+    for response in _iter_github_api_responses(api_path, per_page, installation_id):
+        yield from json_decode.extract_fields(response.content, 'item', fields)
+
+
+def _iter_github_api_responses(api_path, per_page, installation_id):
+    # A page that can't be fetched raises rather than end the list early, which would pass for all of it.
+    separator = '&' if '?' in api_path else '?'
+    url = f'{API_BASE_URL}/{api_path}{separator}per_page={per_page}'
 
-    token = retrieve_token()
+    while url:
+        response = _send_github_api_call(url, 'GET', None, installation_id)
+        if not 200 <= response.status_code < 300:
+            raise GitHubError(f'GET {api_path} returned {response.status_code}: {response.text[:200]}')
+
+        yield response
+        url = response.links.get('next', {}).get('url')
+
+
+def _send_github_api_call(url, method, params, installation_id):
+    token = retrieve_token(installation_id=installation_id)
 
     # Required headers.
     headers = {'Accept': 'application/vnd.github.antiope-preview+json',
@@ -44,33 +115,62 @@ new_comment = make_github_rest_api_call(
                'Authorization': f'Bearer {token}'
                }
 
-    try:
-        if method.upper() == 'POST':
-            response = requests.post(f'{API_BASE_URL}/{api_path}', headers=headers, data=json.dumps(
-                params))
-        elif method.upper() == 'GET':
-            response = requests.get(f'{API_BASE_URL}/{api_path}', headers=headers)
-        else:
-            raise Exception('Invalid Request Method.')
-
-        return json.loads(response.text)
-    except Exception as e:
-        log.exception("Could not make a successful API call to GitHub.")
+    if method.upper() in ('POST', 'PATCH'):
+        return request(method.upper(), url, headers=headers, data=json.dumps(params))
+    elif method.upper() == 'GET':
+        # Conditional GET, GitHub answers 304 without counting it against the rate limit if nothing changed.
+        cache_key = (url, str(installation_id))
+        headers.update(etag_cache.conditional_headers(cache_key))
+        return etag_cache.resolve(cache_key, request('GET', url, headers=headers))
+    else:
+        raise Exception('Invalid Request Method.')
 
 
-def make_github_gql_api_call(query):
+def make_github_gql_api_call(query, installation_id=None):
     """Send API call to Github GraphQL API with required Auth."""
-    token = retrieve_token()
+    token = retrieve_token(installation_id=installation_id)
 
     headers = {'Accept': 'application/vnd.github.ocelot-preview;application/vnd.github.cateye-preview+json', 'Content-Type': 'application/json', 'Authorization': f'token {token}'}
 
-    url = f'https://ghetest.trafficmanager.net/api/graphql?access_token={token}'
+    url = f'{GQL_API_URL}?access_token={token}'
+
+    # Queries are safe to send twice, mutations are not.
+    response = request('POST', url, GRAPHQL, idempotent=not query.lstrip().startswith('mutation'), headers=headers,
+                       json={'query': query})
+    return json_decode.loads(response.content)
+
+
+def iter_gql_connection(query_template, variables, connection_path, page_size=GH_PAGE_SIZE, installation_id=None):
+    """Yield the node pages of a GraphQL connection, following its cursor lazily.
+
+    The query template gets `$page_size` and `$after` substituted (besides the given variables) and
+    must select `nodes` and `pageInfo { hasNextPage endCursor }` of the connection found at
+    `connection_path` under `data`, e.g. `connection(first: $page_size$after)`.
 
-    response = requests.post(url, headers=headers, json={'query': query})
-    return json.loads(response.text)
+    Raise GitHubError if a page can't be read (the response has errors or no such connection), so callers
+    don't mistake the pages read so far for the whole connection.
+    """
+    after = ''
+    while True:
+        query = format_query(query_template, dict(variables, page_size=page_size, after=after))
+        response = make_github_gql_api_call(query, installation_id) or {}
+
+        connection = response.get('data')
+        for key in connection_path:
+            connection = (connection or {}).get(key)
+        if not connection or response.get('errors'):
+            raise GitHubError(f'Could not read {".".join(connection_path)}: {response.get("errors")}')
+
+        yield connection['nodes']
 
+        if not connection['pageInfo']['hasNextPage']:
+            return
+        after = f', after: "{connection["pageInfo"]["endCursor"]}"'
 
-def set_check_on_pr(repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title=None, output_summary=None):
+
+def set_check_on_pr(repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title=None, output_summary=None,
+                    installation_id=None, check_run_id=None):
+    """Create a check run on the head SHA, or update the given one, and return GitHub's response."""
     payload = {
         'name': check_name,
         'status': check_status,
@@ -83,8 +183,13 @@ def set_check_on_pr(repo_full_name, check_name, check_status, check_conclusion,
     if output_title and output_summary:
         payload['output'] = dict(title=output_title, summary=output_summary)
 
+    if check_run_id:
+        del payload['head_sha']
+        api_path = f'repos/{repo_full_name}/check-runs/{check_run_id}'
+        return make_github_api_call(api_path, 'PATCH', params=payload, installation_id=installation_id)
+
     api_path = f'repos/{repo_full_name}/check-runs'
-    make_github_api_call(api_path, 'POST', params=payload)
+    return make_github_api_call(api_path, 'POST', params=payload, installation_id=installation_id)
 
 
 def format_query(template: str, variables: Mapping[str, Any]) -> str:
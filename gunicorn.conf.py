@@ -0,0 +1,45 @@
+import os
+
+# The workers share tokens and handled deliveries through this database (set before the config is read)
+os.environ.setdefault('SHARED_STATE_PATH', 'private/bot_state.db')
+
+from bot_config import SERVER_BIND, SERVER_DRAIN_TIMEOUT, SERVER_THREADS, SERVER_WORKERS
+
+"""
+PRODUCTION SERVER
+==================
+Serves the bot with gunicorn, one worker process per core by default:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app (and everything it imports) is loaded and warmed up once in the master
+process, and the workers are forked from it. Each worker runs its own work
+queue and check publisher, and the workers share installation tokens, handled
+deliveries and their metrics (so `/metrics` and `/queue_status` cover every
+worker) through the SQLite database at SHARED_STATE_PATH.
+
+On SIGTERM a worker stops accepting deliveries, finishes the requests in
+flight, then drains its debounced and queued work and pending check runs
+within SERVER_DRAIN_TIMEOUT seconds.
+"""
+
+bind = SERVER_BIND
+workers = SERVER_WORKERS
+worker_class = 'gthread'
+threads = SERVER_THREADS
+preload_app = True
+timeout = 60
+# Time for the requests in flight plus draining, before the master kills the worker
+graceful_timeout = SERVER_DRAIN_TIMEOUT + 10
+
+
+def post_fork(server, worker):
+    from wsgi import start
+
+    start()
+
+
+def worker_exit(server, worker):
+    from wsgi import drain
+
+    drain(SERVER_DRAIN_TIMEOUT)
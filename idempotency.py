@@ -0,0 +1,147 @@
+import collections
+import contextlib
+import logging
+import shared_store
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from bot_config import IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_DB_PATH, IDEMPOTENCY_TTL
+
+log = logging.getLogger(__name__)
+
+"""
+IDEMPOTENCY STORE
+==================
+Remembers what was already handled, so a webhook GitHub delivers again (same
+`X-GitHub-Delivery` GUID) or an event that cannot change a result (same repo, PR,
+head SHA and check) is dropped before it costs any call to GitHub.
+
+Claims are kept in an LRU of IDEMPOTENCY_CACHE_SIZE keys per kind, and also in
+the SQLite database at IDEMPOTENCY_DB_PATH when one is configured (by default the
+shared store), so they survive restarts and are shared by the processes using it. Claims older than
+IDEMPOTENCY_TTL seconds are forgotten.
+"""
+
+DELIVERY = 'delivery'
+RESULT = 'result'
+
+# kind -> OrderedDict(key -> claimed_at)
+_claims = collections.defaultdict(collections.OrderedDict)
+_lock = threading.Lock()
+_counters = collections.Counter()
+_table_created = False
+# Expired claims are deleted from the database every this many claims
+_PRUNE_EVERY = 1000
+
+
+def claim(kind, key):
+    """Claim a key of a kind (DELIVERY or RESULT). Return False if it was claimed already."""
+    key = _key_string(key)
+    now = time.time()
+
+    with _lock:
+        claims = _claims[kind]
+        claimed_at = claims.get(key)
+        if claimed_at is not None and claimed_at + IDEMPOTENCY_TTL > now:
+            claims.move_to_end(key)
+            _counters[f'{kind}_duplicates'] += 1
+            return False
+
+        claimed = _claim_in_db(kind, key, now)
+        claims[key] = now
+        claims.move_to_end(key)
+        while len(claims) > IDEMPOTENCY_CACHE_SIZE:
+            claims.popitem(last=False)
+
+        _counters[f'{kind}_claimed' if claimed else f'{kind}_duplicates'] += 1
+        return claimed
+
+
+def release(kind, key):
+    """Forget a claim, e.g. when the delivery could not be queued and GitHub should deliver it again."""
+    key = _key_string(key)
+    with _lock:
+        _claims[kind].pop(key, None)
+        if not IDEMPOTENCY_DB_PATH:
+            return
+
+        try:
+            with _transaction() as db:
+                db.execute('DELETE FROM claims WHERE kind = ? AND key = ?', (kind, key))
+        except (sqlite3.Error, OSError):
+            log.error(f'Could not release {kind} claim {key}.')
+            traceback.print_exc(file=sys.stderr)
+
+
+def claim_delivery(delivery_id):
+    """Claim a webhook delivery by its GUID. Deliveries without one are never treated as duplicates."""
+    return not delivery_id or claim(DELIVERY, delivery_id)
+
+
+def claim_result(repo_full_name, pr_number, head_sha, check_name):
+    """Claim the result of a check on a PR head SHA."""
+    return claim(RESULT, (repo_full_name, pr_number, head_sha, check_name))
+
+
+def release_delivery(delivery_id):
+    """Forget a claimed webhook delivery."""
+    if delivery_id:
+        release(DELIVERY, delivery_id)
+
+
+def release_result(repo_full_name, pr_number, head_sha, check_name):
+    """Forget a claimed check result, e.g. when the check failed to run."""
+    release(RESULT, (repo_full_name, pr_number, head_sha, check_name))
+
+
+def idempotency_stats():
+    """Return how many keys were claimed and how many duplicates dropped, per kind."""
+    with _lock:
+        stats = dict(_counters)
+        for kind, claims in _claims.items():
+            stats[f'{kind}_cached'] = len(claims)
+    return stats
+
+
+def _key_string(key):
+    return '\x1f'.join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+
+
+def _claim_in_db(kind, key, now):
+    """Insert the claim unless a live one exists. Return False if it does. Called with the lock held."""
+    if not IDEMPOTENCY_DB_PATH:
+        return True
+
+    try:
+        with _transaction() as db:
+            # A claim that expired may be taken over.
+            db.execute('DELETE FROM claims WHERE kind = ? AND key = ? AND claimed_at <= ?',
+                       (kind, key, now - IDEMPOTENCY_TTL))
+            inserted = db.execute('INSERT OR IGNORE INTO claims (kind, key, claimed_at) VALUES (?, ?, ?)',
+                                  (kind, key, now)).rowcount == 1
+
+            _counters['db_claims'] += 1
+            if _counters['db_claims'] % _PRUNE_EVERY == 0:
+                db.execute('DELETE FROM claims WHERE claimed_at <= ?', (now - IDEMPOTENCY_TTL,))
+        return inserted
+
+    except (sqlite3.Error, OSError):
+        # Better to handle a duplicate than to drop a delivery.
+        log.error(f'Could not store {kind} claim {key}.')
+        traceback.print_exc(file=sys.stderr)
+        return True
+
+
+@contextlib.contextmanager
+def _transaction():
+    global _table_created
+
+    with shared_store.transaction(IDEMPOTENCY_DB_PATH) as db:
+        if not _table_created:
+            db.execute('CREATE TABLE IF NOT EXISTS claims '
+                       '(kind TEXT NOT NULL, key TEXT NOT NULL, claimed_at REAL NOT NULL, PRIMARY KEY (kind, key))')
+            _table_created = True
+        yield db
@@ -0,0 +1,227 @@
+import collections
+import logging
+import os
+import shared_store
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from bot_config import JOB_JOURNAL_FLUSH_INTERVAL, JOB_JOURNAL_LEASE, JOB_JOURNAL_PATH
+from priority import ensure_thread
+
+log = logging.getLogger(__name__)
+
+"""
+JOB JOURNAL
+============
+Keeps the check evaluations the bot still owes, one per (repo, PR, check), in
+the SQLite database at JOB_JOURNAL_PATH, so a restart does not lose the
+deliveries still queued or debounced. A job is recorded when its delivery is
+received and removed once its handler ran; recording it again (a newer
+delivery) replaces it.
+
+Writes are batched: a writer thread commits whatever was recorded or completed
+within JOB_JOURNAL_FLUSH_INTERVAL seconds in one transaction, so there is a
+single fsync per batch instead of one per job.
+
+Every process holds a lease on the jobs it recorded, renewed by the writer
+thread. Jobs whose lease ran out for JOB_JOURNAL_LEASE seconds (their process
+stopped or crashed) are adopted by a running process and handed to the function
+given to `start`, which runs them again.
+"""
+
+# Identifies the jobs of this process, renewed in a forked child
+_owner = uuid.uuid4().hex
+# (sql, params) waiting to be committed
+_writes = []
+_condition = threading.Condition()
+_counters = collections.Counter()
+_thread = None
+_committing = False
+_replay = None
+# Set once the connection of this process is set up
+_table_created = False
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS jobs (repo TEXT NOT NULL, pr_number TEXT NOT NULL, check_name TEXT NOT NULL, '
+    'head_sha TEXT, installation_id TEXT, token TEXT NOT NULL, owner TEXT NOT NULL, recorded_at REAL NOT NULL, '
+    'PRIMARY KEY (repo, pr_number, check_name))',
+    'CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, renewed_at REAL NOT NULL)',
+]
+
+
+def start(replay):
+    """Start journaling in this process, adopting the jobs of stopped processes and calling `replay(job)` on them.
+
+    A job is a dict of repo, pr_number, check_name, head_sha, installation_id and token.
+    """
+    global _replay
+
+    _replay = replay
+    if JOB_JOURNAL_PATH:
+        with _condition:
+            _start_thread()
+
+
+def record(repo_full_name, pr_number, check_name, head_sha=None, installation_id=None):
+    """Record a job owed by this process and return it, to `complete` once it ran (None without a journal)."""
+    if not JOB_JOURNAL_PATH:
+        return None
+
+    job = dict(repo=repo_full_name, pr_number=str(pr_number), check_name=check_name, head_sha=head_sha,
+               installation_id=None if installation_id is None else str(installation_id), token=uuid.uuid4().hex)
+    _write('INSERT OR REPLACE INTO jobs (repo, pr_number, check_name, head_sha, installation_id, token, owner, '
+           'recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+           (job['repo'], job['pr_number'], check_name, head_sha, job['installation_id'], job['token'], _owner,
+            time.time()), 'recorded')
+    return job
+
+
+def complete(job):
+    """Remove a job that ran, unless it was recorded again since."""
+    if not job:
+        return
+
+    _write('DELETE FROM jobs WHERE repo = ? AND pr_number = ? AND check_name = ? AND token = ?',
+           (job['repo'], job['pr_number'], job['check_name'], job['token']), 'completed')
+
+
+def flush(timeout=None):
+    """Wait until the recorded and completed jobs are committed. Return False if not done within the timeout."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _condition:
+        while _writes or _committing:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            _condition.wait(remaining)
+    return True
+
+
+def release():
+    """Give up the lease of this process, so another one adopts its jobs left over right away (e.g. on shutdown)."""
+    if JOB_JOURNAL_PATH:
+        _write('DELETE FROM owners WHERE owner = ?', (_owner,), 'released')
+
+
+def journal_stats():
+    """Return how many jobs were recorded, completed and adopted, and how many writes wait to be committed."""
+    with _condition:
+        stats = dict(_counters)
+        stats['waiting'] = len(_writes)
+    return stats
+
+
+def _write(sql, params, counter):
+    with _condition:
+        _writes.append((sql, params))
+        _counters[counter] += 1
+        _start_thread()
+        _condition.notify_all()
+
+
+def _start_thread():
+    global _thread
+
+    _thread = ensure_thread(_thread, 'job-journal', _write_loop)
+
+
+def _write_loop():
+    global _committing
+
+    renew_interval = max(JOB_JOURNAL_LEASE / 3, JOB_JOURNAL_FLUSH_INTERVAL)
+    renewed_at = 0
+
+    while True:
+        with _condition:
+            if not _writes:
+                _condition.wait(max(renewed_at + renew_interval - time.monotonic(), 0))
+
+        if _writes:
+            # Let the writes of the next moments join the batch.
+            time.sleep(JOB_JOURNAL_FLUSH_INTERVAL)
+
+        with _condition:
+            writes = _writes[:]
+            del _writes[:]
+            _committing = True
+
+        renew = time.monotonic() >= renewed_at + renew_interval
+        try:
+            adopted = _commit(writes, renew)
+            if renew:
+                renewed_at = time.monotonic()
+        except (sqlite3.Error, OSError):
+            log.error(f'Could not write {len(writes)} job journal changes.')
+            traceback.print_exc(file=sys.stderr)
+            adopted = []
+        finally:
+            with _condition:
+                _committing = False
+                _condition.notify_all()
+
+        for job in adopted:
+            _replay_job(job)
+
+
+def _commit(writes, renew):
+    """Commit the writes in one transaction. When renewing the lease, also adopt the jobs of expired leases."""
+    global _table_created
+
+    adopted = []
+    with shared_store.transaction(JOB_JOURNAL_PATH) as connection:
+        if not _table_created:
+            # The journal is worth a sync per batch (the shared store only syncs at checkpoints).
+            connection.execute('PRAGMA synchronous=FULL')
+            for statement in _SCHEMA:
+                connection.execute(statement)
+            _table_created = True
+
+        for sql, params in writes:
+            connection.execute(sql, params)
+
+        if renew:
+            now = time.time()
+            connection.execute('INSERT OR REPLACE INTO owners (owner, renewed_at) VALUES (?, ?)', (_owner, now))
+            if _replay is not None:
+                adopted = _adopt(connection, now)
+            connection.execute('DELETE FROM owners WHERE renewed_at < ?', (now - JOB_JOURNAL_LEASE,))
+
+    return adopted
+
+
+def _adopt(connection, now):
+    live_owners = 'SELECT owner FROM owners WHERE renewed_at >= ?'
+    rows = connection.execute('SELECT repo, pr_number, check_name, head_sha, installation_id, token FROM jobs '
+                              f'WHERE owner NOT IN ({live_owners})', (now - JOB_JOURNAL_LEASE,)).fetchall()
+    connection.execute(f'UPDATE jobs SET owner = ? WHERE owner NOT IN ({live_owners})',
+                       (_owner, now - JOB_JOURNAL_LEASE))
+
+    columns = ('repo', 'pr_number', 'check_name', 'head_sha', 'installation_id', 'token')
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _replay_job(job):
+    with _condition:
+        _counters['adopted'] += 1
+
+    try:
+        _replay(job)
+    except Exception:
+        log.error(f'Could not replay job {job}.')
+        traceback.print_exc(file=sys.stderr)
+
+
+def _reset_after_fork():
+    global _owner, _table_created
+
+    # The child records jobs of its own, under its own lease, through a connection of its own.
+    _owner = uuid.uuid4().hex
+    _table_created = False
+    del _writes[:]
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
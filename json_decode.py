@@ -0,0 +1,74 @@
+import io
+import json
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+"""
+JSON DECODING
+==============
+Decodes GitHub responses straight from their bytes, skipping the intermediate
+`str` that `json.loads(response.text)` builds.
+
+Two optional backends are used when installed:
+- `orjson` to decode whole documents faster, and
+- `ijson` to pull only the wanted fields out of a big document (e.g. the SHA and
+  message of every commit of a PR), without building the whole object tree.
+Without them the standard `json` module is used.
+"""
+
+
+@metrics.timed('bot_json_decode_duration_seconds')
+def loads(content):
+    """Decode a JSON document from bytes (or str)."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def extract_fields(content, prefix, fields):
+    """Yield a dict with only the given fields of every object found at the prefix of a JSON document.
+
+    `prefix` and `fields` use dotted paths, with `item` standing for every element of a list, e.g. the
+    commit list of a PR with prefix `item` and fields `('sha', 'commit.message')` yields dicts like
+    `{'sha': ..., 'commit.message': ...}`. Missing fields are left out.
+
+    With `ijson` only one object at a time is decoded, otherwise the whole document is.
+    """
+    if ijson is not None:
+        stream = io.BytesIO(content.encode('utf-8') if isinstance(content, str) else content)
+        items = ijson.items(stream, prefix)
+    else:
+        items = _walk(loads(content), prefix.split('.') if prefix else [])
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+
+        record = {}
+        for field in fields:
+            values = list(_walk(item, field.split('.')))
+            if values:
+                record[field] = values[0]
+        yield record
+
+
+def _walk(value, path):
+    if not path:
+        yield value
+        return
+
+    key, rest = path[0], path[1:]
+    if key == 'item' and isinstance(value, list):
+        for element in value:
+            yield from _walk(element, rest)
+    elif isinstance(value, dict) and key in value:
+        yield from _walk(value[key], rest)
@@ -0,0 +1,196 @@
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import shared_store
+import sys
+import threading
+import time
+import traceback
+
+from bot_config import METRICS_SHARE_INTERVAL
+from priority import ensure_thread
+
+log = logging.getLogger(__name__)
+
+"""
+METRICS
+========
+Latency histograms of the handlers, the calls to GitHub, token retrieval and
+JSON decoding, rendered in the Prometheus text format (by the `/metrics` route,
+along with gauges of the queues, caches and rate limits).
+
+Observing a duration takes a bisect and a few additions under a lock, so the
+instrumentation stays on in production.
+"""
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name -> {sorted label items: [count per bucket (the last one for +Inf)..., sum]}
+_histograms = {}
+_lock = threading.Lock()
+
+
+def observe(name, seconds, **labels):
+    """Add a duration to the histogram of the name and labels."""
+    key = tuple(sorted(labels.items()))
+    index = bisect.bisect_left(BUCKETS, seconds)
+
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        values = series.get(key)
+        if values is None:
+            values = series[key] = [0] * (len(BUCKETS) + 2)
+        values[index] += 1
+        values[-1] += seconds
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Observe how long the `with` block takes."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorate a function to observe how long its calls take, labelled with the function name."""
+    def decorate(func):
+        function_labels = dict(labels, function=func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **function_labels)
+
+        return wrapper
+
+    return decorate
+
+
+def snapshot():
+    """Return the histograms as JSON serializable [name, labels, values] entries, to render in another process."""
+    with _lock:
+        return [[name, dict(key), list(values)] for name, series in _histograms.items()
+                for key, values in series.items()]
+
+
+def render(gauges=(), snapshots=None):
+    """Return the histograms, and the given (name, labels, value) gauges, in the Prometheus text format.
+
+    The histograms are those of this process, or the sum of the given `snapshot`s.
+    """
+    histograms = {}
+    for entries in ([snapshot()] if snapshots is None else snapshots):
+        for name, labels, values in entries:
+            key = tuple(sorted(labels.items()))
+            total = histograms.setdefault(name, {}).get(key)
+            histograms[name][key] = values if total is None else [a + b for a, b in zip(total, values)]
+
+    lines = []
+    for name, series in sorted(histograms.items()):
+        lines.append(f'# TYPE {name} histogram')
+        for key, values in sorted(series.items()):
+            labels = dict(key)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(dict(labels, le=bound))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {values[-1]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+
+    typed = set()
+    # The samples of a metric go together.
+    for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+        if name not in typed:
+            lines.append(f'# TYPE {name} gauge')
+            typed.add(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+"""
+SHARED METRICS
+===============
+The workers of the production server each keep their own histograms, queues and
+caches. With a shared store (SHARED_STATE_PATH) every serving process publishes
+them there every METRICS_SHARE_INTERVAL seconds, so whichever worker answers a
+scrape renders those of every worker. A process stopped for longer than a few
+intervals drops out, and with it its share of the histogram counts.
+"""
+
+# Namespace of the shared store holding the published metrics by process id
+_SHARED_METRICS = 'metrics'
+
+_collect = None
+_sharer = None
+
+
+def start_sharing(collect):
+    """Publish the histograms of this process, along with the JSON serializable dict `collect` returns, regularly.
+
+    Does nothing without a shared store.
+    """
+    global _collect, _sharer
+
+    if not shared_store.enabled():
+        return
+
+    _collect = collect
+    _sharer = ensure_thread(_sharer, 'metrics-sharer', _share_loop)
+
+
+def sharing():
+    """Whether the metrics of every process are published, see `shared_metrics`."""
+    return _collect is not None
+
+
+def shared_metrics():
+    """Return {process id: dict(histograms=snapshot, **collected)} of the processes publishing their metrics.
+
+    Those of this process are published again first, so they are current.
+    """
+    own = _share()
+    try:
+        published = shared_store.items(_SHARED_METRICS)
+    except Exception as exc:
+        log.error(f'Could not read the metrics of the other processes.\n{exc}')
+        traceback.print_exc(file=sys.stderr)
+        published = {}
+    published[str(os.getpid())] = own
+    return published
+
+
+def _share_loop():
+    while True:
+        time.sleep(METRICS_SHARE_INTERVAL)
+        _share()
+
+
+def _share():
+    published = dict(_collect(), histograms=snapshot())
+    try:
+        shared_store.put(_SHARED_METRICS, str(os.getpid()), published,
+                         expires_at=time.time() + 3 * METRICS_SHARE_INTERVAL)
+    except Exception as exc:
+        log.error(f'Could not publish the metrics of this process.\n{exc}')
+        traceback.print_exc(file=sys.stderr)
+    return published
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
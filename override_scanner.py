@@ -0,0 +1,49 @@
+import collections
+import threading
+
+from constants import OVERRIDE_ALLOWED
+
+"""
+OVERRIDE SCANNER
+=================
+Finds the overrides (see constants.OVERRIDE_ALLOWED) used in the commit messages
+of a PR. Every message is scanned once for all overrides, and the result is
+remembered by commit SHA, so commits already seen on an earlier sync of the PR
+are not scanned again.
+
+Plain substring checks are used on purpose: for a handful of literal overrides
+CPython's substring search beats a compiled regex alternation by a wide margin.
+"""
+
+_OVERRIDES_CACHE_SIZE = 100000
+
+# commit SHA -> frozenset of the overrides in its message
+_overrides_by_sha = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def find_overrides(message, overrides=tuple(OVERRIDE_ALLOWED)):
+    """Return the overrides found in a commit message."""
+    return frozenset(override for override in overrides if override in message)
+
+
+def find_commit_overrides(commits):
+    """Return the overrides found in the messages of the commits, as returned by the pulls API."""
+    found = set()
+
+    for commit in commits:
+        sha = commit.get('sha')
+        with _lock:
+            overrides = _overrides_by_sha.get(sha) if sha else None
+
+        if overrides is None:
+            overrides = find_overrides(str(commit['commit']['message']))
+            if sha:
+                with _lock:
+                    _overrides_by_sha[sha] = overrides
+                    if len(_overrides_by_sha) > _OVERRIDES_CACHE_SIZE:
+                        _overrides_by_sha.popitem(last=False)
+
+        found |= overrides
+
+    return found
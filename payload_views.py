@@ -0,0 +1,146 @@
+"""
+PAYLOAD VIEWS
+==============
+Light, `__slots__` based views over the GitHub payloads the handlers read.
+
+The fields the handlers use are pulled out of the payload once, when the view
+is built; anything else is still reachable through `get` or `raw` without
+wrapping every level of the payload in objects. A webhook only wraps the parts
+of its payload in their views when they are first read, and lists such as the
+labels of a PR are only built when asked for. A missing part of the payload is
+`None` (e.g. `webhook.pull_request` of an `issue_comment` event).
+"""
+
+
+class PayloadView:
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw if isinstance(raw, dict) else {}
+
+    def get(self, *path, default=None):
+        """Return the value at the given path of keys (and list indexes) of the payload."""
+        value = self.raw
+        for key in path:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+        return default if value is None else value
+
+    def __bool__(self):
+        return bool(self.raw)
+
+
+class RepositoryView(PayloadView):
+    __slots__ = ('full_name', 'owner', 'name')
+
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.full_name = self.raw.get('full_name') or ''
+        self.owner, _, self.name = self.full_name.partition('/')
+
+
+class PullRequestView(PayloadView):
+    __slots__ = ('number', 'head_sha', 'body', 'updated_at')
+
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.number = _str_or_none(self.raw.get('number'))
+        self.head_sha = self.get('head', 'sha')
+        self.body = self.raw.get('body') or ''
+        self.updated_at = self.raw.get('updated_at')
+
+    @property
+    def labels(self):
+        return [label.get('name') for label in self.raw.get('labels') or []]
+
+
+class CheckRunView(PayloadView):
+    __slots__ = ('name', 'head_sha', 'pull_request_numbers')
+
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.name = self.raw.get('name')
+        self.head_sha = self.raw.get('head_sha')
+        self.pull_request_numbers = [str(pull_request['number']) for pull_request in
+                                     self.raw.get('pull_requests') or [] if pull_request.get('number')]
+
+
+class IssueView(PayloadView):
+    __slots__ = ('number', 'is_pull_request')
+
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.number = _str_or_none(self.raw.get('number'))
+        self.is_pull_request = bool(self.raw.get('pull_request'))
+
+
+class CommentView(PayloadView):
+    __slots__ = ('id', 'body')
+
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.id = self.raw.get('id')
+        self.body = self.raw.get('body') or ''
+
+
+# What the slot of a sub-view holds until it is first read
+_UNREAD = object()
+
+
+class _SubView:
+    """The part of a webhook's payload under the attribute's name, wrapped in its view when first read."""
+
+    def __init__(self, view_class):
+        self.view_class = view_class
+
+    def __set_name__(self, owner, name):
+        self.key = name
+        self.slot = f'_{name}'
+
+    def __get__(self, webhook, owner=None):
+        if webhook is None:
+            return self
+        view = getattr(webhook, self.slot)
+        if view is _UNREAD:
+            view = _view_or_none(self.view_class, webhook.raw.get(self.key))
+            setattr(webhook, self.slot, view)
+        return view
+
+
+class WebhookView(PayloadView):
+    __slots__ = ('event_type', 'action', 'installation_id', '_repository', '_pull_request', '_check_run', '_issue',
+                 '_comment')
+
+    repository = _SubView(RepositoryView)
+    pull_request = _SubView(PullRequestView)
+    check_run = _SubView(CheckRunView)
+    issue = _SubView(IssueView)
+    comment = _SubView(CommentView)
+
+    def __init__(self, raw, event_type=None):
+        super().__init__(raw)
+        self.event_type = event_type
+        self.action = str(self.raw.get('action') or '').lower()
+        self.installation_id = self.get('installation', 'id')
+        self._repository = self._pull_request = self._check_run = self._issue = self._comment = _UNREAD
+
+    @property
+    def pr_number(self):
+        """The PR the event is about, whichever part of the payload says so."""
+        if self.pull_request:
+            return self.pull_request.number
+        if self.issue and self.issue.is_pull_request:
+            return self.issue.number
+        if self.check_run and self.check_run.pull_request_numbers:
+            return self.check_run.pull_request_numbers[0]
+        return None
+
+
+def _view_or_none(view_class, raw):
+    return view_class(raw) if raw else None
+
+
+def _str_or_none(value):
+    return None if value is None else str(value)
@@ -0,0 +1,99 @@
+import collections
+
+from constants import OVERRIDE_ALLOWED
+from override_scanner import find_overrides
+
+"""
+POLICIES
+=========
+The checks the bot sets on PRs. A policy is a function of the PR context and of
+its settings, returning the CheckResult to publish under its check run name (or
+None to publish nothing). It is registered with `policy`, declaring:
+
+- the data it reads from the context (see NEEDS), which the policy engine
+  fetches once for all the policies it evaluates together, and
+- its default settings, which the policy config may change per repo (see
+  policy_engine.py). Every policy has an `enabled` setting.
+
+To add a policy, register it here and route the events it reacts to in
+event_router.py. It costs no GitHub call of its own as long as it only reads
+data other policies need too.
+"""
+
+# Data a policy may need -> the PullRequestContext attribute fetching it
+NEEDS = {
+    'body': 'details',
+    'labels': 'details',
+    'commits': 'commits',
+    'review_threads': 'conversation_counts',
+}
+
+CheckResult = collections.namedtuple('CheckResult', ['conclusion', 'title', 'summary'])
+Policy = collections.namedtuple('Policy', ['name', 'evaluate', 'needs', 'defaults'])
+
+# Check run name -> Policy, in the order they were registered
+POLICIES = collections.OrderedDict()
+
+
+def policy(name, needs=(), enabled=True, **defaults):
+    """Register the decorated `evaluate(context, settings)` function as the policy setting the named check run."""
+    unknown = set(needs) - set(NEEDS)
+    if unknown:
+        raise ValueError(f'Policy {name} needs unknown data: {sorted(unknown)}')
+
+    def register(evaluate):
+        POLICIES[name] = Policy(name, evaluate, frozenset(needs), dict(defaults, enabled=enabled))
+        return evaluate
+
+    return register
+
+
+@policy('PR Basic Information Check', needs=('body',), min_description_length=5)
+def pr_template_check(context, settings):
+    if len(context.body) >= settings['min_description_length']:
+        return CheckResult('success', 'Required information has been filed',
+                           'Required information of this pull request has been filled.')
+
+    return CheckResult('failure', 'Required information is still missing',
+                       'Please make sure the Pull Request Description section is filled.')
+
+
+# Off unless the policy config turns it on, until it knows whether the MP is locked
+@policy('Multiproduct Trunk Status', needs=('commits',), enabled=False, override='TRUNKBLOCKERFIX')
+def check_trunk_status(context, settings):
+    override = settings['override']
+
+    # context.overrides only holds the overrides of OVERRIDE_ALLOWED, others are looked for in the messages
+    if override in OVERRIDE_ALLOWED:
+        overridden = override in context.overrides
+    else:
+        overridden = any(find_overrides(message, (override,)) for message in context.commit_messages)
+
+    if overridden:
+        return CheckResult('success', 'MP lock overridden', f'''Forced status check to success via `{override}` override.
+        More information about this override can be found [here](https://iwww.corp.linkedin.com/wiki/cf/display/TOOLS/Multiproduct+Trunk+Development#MultiproductTrunkDevelopment-TRUNKBLOCKERFIX).
+        ''')
+
+    return CheckResult('failure', 'MP locked, merge not allowed', f'''MP locked by owners of this Multiproduct. No new merges are allowed at this time.
+    You may override this check by adding string `{override}` to the comment message and sync the commit to Github.
+    Doing so will notify the owners of this merge. Read more about MP lock policy [here](https://iwww.corp.linkedin.com/wiki/cf/display/TOOLS/questions/184796939/what-is-the-recommended-way-to-lock-checkins-to-multiproduct).
+    ''')
+
+
+@policy('Conversation Resolution', needs=('review_threads',))
+def check_conversation_resolution(context, settings):
+    resolved, total = context.conversation_counts
+    return conversation_result(resolved, total)
+
+
+def conversation_result(resolved, total):
+    """Return the CheckResult of a PR with `resolved` of its `total` review threads resolved."""
+    if resolved == total:
+        return CheckResult('success', 'There are no unresolved conversations',
+                           'Check passed as there are no unresolved conversations on this pull request.')
+
+    return CheckResult('failure', f'{resolved}/{total} conversations resolved',
+                       f'Check failed because only {resolved}/{total} conversations resolved. '
+                       f'Please handle the unresolved one(s).\n'
+                       f'To refresh this check, re-run manually or wait for the next automated run in 1 minute. \n\n'
+                       f'More information about how the check is conducted can be found [here](https://linkedin.com/).')
@@ -0,0 +1,201 @@
+import collections
+import functools
+import gh_async
+import json
+import logging
+import metrics
+import os
+import sys
+import threading
+import time
+import traceback
+
+from bot_config import POLICY_CONFIG_PATH
+from check_publisher import publish_checks
+from policies import NEEDS, POLICIES
+
+log = logging.getLogger(__name__)
+
+"""
+POLICY ENGINE
+==============
+Evaluates the policies of policies.py on a PR:
+
+1. the rule set of the repo tells which policies are on, with which settings;
+   it is compiled once per repo config and cached (until POLICY_CONFIG_PATH
+   changes),
+2. the data the policies need is fetched once, the different pieces
+   concurrently,
+3. the policies are evaluated on that data, and
+4. their check runs are published together.
+
+Policies are evaluated once their data is in hand, one after the other: they
+are plain computations by then, and evaluating them on the async client's pool
+would have them hold GitHub call slots (see gh_async) while they wait for the
+fetches needing those slots. A piece of data that could not be fetched is
+left to the policies reading it, which then fail on their own (and publish
+nothing) while the others still publish.
+
+POLICY_CONFIG_PATH is a JSON file of settings per policy (check run name) for
+every repo (`*`), the repos of an owner (`owner/*`) and single repos
+(`owner/repo`), the most specific one winning:
+
+    {
+        "*": {"Multiproduct Trunk Status": {"enabled": true}},
+        "li-foundation/zac-test-repo": {"PR Basic Information Check": {"min_description_length": 20}}
+    }
+"""
+
+# A policy that is on for a repo, with its settings and the context attributes it needs fetched
+Rule = collections.namedtuple('Rule', ['policy', 'settings', 'fetches'])
+
+# repo full name -> {check name: Rule} of the policies on for it
+_rule_sets = {}
+# settings (as JSON) -> rule set, shared by the repos with the same settings
+_compiled = {}
+_config = {}
+# (mtime, size) of the config file loaded
+_config_version = None
+_lock = threading.Lock()
+_counters = collections.Counter()
+
+
+def rule_set(repo_full_name):
+    """Return {check name: Rule} of the policies on for the repo, in the order they were registered."""
+    with _lock:
+        _reload_config()
+        rules = _rule_sets.get(repo_full_name)
+        if rules is None:
+            settings = _settings_of(repo_full_name)
+            key = json.dumps(settings, sort_keys=True)
+            rules = _compiled.get(key)
+            if rules is None:
+                rules = _compiled[key] = _compile(settings)
+                _counters['compiled'] += 1
+            _rule_sets[repo_full_name] = rules
+        return rules
+
+
+def enabled(repo_full_name, policy_names):
+    """Return the names of the policies among the given ones that are on for the repo."""
+    rules = rule_set(repo_full_name)
+    return [name for name in policy_names if name in rules]
+
+
+def evaluate(context, policy_names):
+    """Evaluate the policies among the given ones that are on for the PR's repo. Return {check name: CheckResult}.
+
+    A policy that fails is logged and left out, the others are still returned.
+    """
+    rules = [rule for name, rule in rule_set(context.repo_full_name).items() if name in policy_names]
+    if not rules:
+        return {}
+
+    fetches = {attribute for rule in rules for attribute in rule.fetches}
+    if not context.knows_head_sha:
+        fetches.add('details')
+    # A single piece is fetched by the policy reading it.
+    tasks = [functools.partial(getattr, context, attribute) for attribute in sorted(context.missing(fetches))]
+    if len(tasks) > 1:
+        gh_async.run_concurrently(*tasks, installation_id=context.installation_id, return_exceptions=True)
+
+    results = {rule.policy.name: _evaluate(rule, context) for rule in rules}
+    return {name: result for name, result in results.items() if result is not None}
+
+
+def run(context, policy_names):
+    """Evaluate the policies on the PR and publish their check runs together."""
+    results = evaluate(context, policy_names)
+
+    head_sha = context.head_sha
+    # Incomplete info, give up
+    if not results or not head_sha:
+        return
+
+    publish_checks([(context.repo_full_name, name, 'completed', result.conclusion, head_sha, result.title,
+                     result.summary, context.installation_id) for name, result in results.items()])
+
+
+def engine_stats():
+    """Return how many rule sets were compiled, how many repos have one, and how many policies failed."""
+    with _lock:
+        stats = dict(_counters)
+        stats['repos'] = len(_rule_sets)
+    return stats
+
+
+def _evaluate(rule, context):
+    start = time.perf_counter()
+    try:
+        return rule.policy.evaluate(context, rule.settings)
+    except Exception:
+        with _lock:
+            _counters['failed'] += 1
+        log.error(f'Policy {rule.policy.name} failed on {context.repo_full_name}#{context.pr_number}.')
+        traceback.print_exc(file=sys.stderr)
+        return None
+    finally:
+        metrics.observe('bot_policy_duration_seconds', time.perf_counter() - start, policy=rule.policy.name)
+
+
+def _reload_config():
+    """Load the config file again if it changed since, dropping the rule sets compiled from the previous one."""
+    global _config, _config_version
+
+    if not POLICY_CONFIG_PATH:
+        return
+
+    try:
+        stat = os.stat(POLICY_CONFIG_PATH)
+    except OSError:
+        stat = None
+    version = (stat.st_mtime, stat.st_size) if stat else None
+    if version == _config_version:
+        return
+
+    try:
+        config = {}
+        if stat:
+            with open(POLICY_CONFIG_PATH) as config_file:
+                config = json.load(config_file)
+            _validate(config)
+    except (OSError, ValueError):
+        log.error(f'Could not load the policy config {POLICY_CONFIG_PATH}, keeping the previous one.')
+        traceback.print_exc(file=sys.stderr)
+        return
+    finally:
+        # A broken file is not read again until it changes.
+        _config_version = version
+
+    _config = config
+    _rule_sets.clear()
+    _compiled.clear()
+
+
+def _validate(config):
+    if not isinstance(config, dict) or not all(isinstance(policies, dict) for policies in config.values()):
+        raise ValueError('The policy config must map repos to {check name: settings}')
+
+    for scope, policies in config.items():
+        for name, settings in policies.items():
+            if name not in POLICIES:
+                log.warning(f'Ignoring unknown policy {name!r} of {scope} in {POLICY_CONFIG_PATH}')
+            elif not isinstance(settings, dict):
+                raise ValueError(f'The settings of {name!r} of {scope} must be an object')
+
+
+def _settings_of(repo_full_name):
+    """Return {check name: settings} of every policy for the repo, the defaults overridden by the config."""
+    owner = repo_full_name.partition('/')[0]
+    settings = {name: dict(policy.defaults) for name, policy in POLICIES.items()}
+    for scope in ('*', f'{owner}/*', repo_full_name):
+        for name, overrides in _config.get(scope, {}).items():
+            if name in settings:
+                settings[name].update(overrides)
+    return settings
+
+
+def _compile(settings):
+    return collections.OrderedDict(
+        (name, Rule(policy, settings[name], frozenset(NEEDS[need] for need in policy.needs)))
+        for name, policy in POLICIES.items() if settings[name]['enabled'])
@@ -0,0 +1,216 @@
+import collections
+import functools
+import gh_async
+import logging
+import threading
+import time
+
+from bot_config import PR_CONTEXT_CACHE_SIZE, PR_CONTEXT_TTL
+from gh_session import GRAPHQL
+from gh_utils import iter_github_api_fields, iter_gql_connection, make_github_api_call
+from override_scanner import find_commit_overrides
+from payload_views import PullRequestView
+
+log = logging.getLogger(__name__)
+
+"""
+PR CONTEXT
+===========
+What the checks need to know about one PR, fetched lazily and at most once per
+event, so several checks handling the same delivery share the GitHub calls.
+
+The commits of a PR at a head SHA don't change, so they are also kept in a small
+cache for PR_CONTEXT_TTL seconds and reused by the following events on that SHA.
+The PR details and review threads do change between events and are only
+shared within one. A PR that was just opened has no review threads, so they are
+not fetched for its `opened` event.
+"""
+
+# (repo_full_name, pr_number, head_sha) -> (fetched_at, commits)
+_commits_cache = collections.OrderedDict()
+_commits_cache_lock = threading.Lock()
+_counters = collections.Counter()
+
+
+class PullRequestContext:
+
+    def __init__(self, repo_full_name, pr_number, head_sha=None, details=None, installation_id=None,
+                 conversation_counts=None):
+        self.repo_full_name = repo_full_name
+        self.owner, _, self.repo = repo_full_name.partition('/')
+        self.pr_number = pr_number
+        self.installation_id = installation_id
+        self._head_sha = head_sha
+        self._details = details
+        self._commits = None
+        self._conversation_counts = conversation_counts
+        # One lock per piece of data, so different pieces can be fetched concurrently.
+        self._details_lock = threading.Lock()
+        self._commits_lock = threading.Lock()
+        self._threads_lock = threading.Lock()
+
+    @classmethod
+    def from_webhook(cls, webhook):
+        """Build the context of the PR a webhook is about, or None if it is not about a PR."""
+        if not webhook.repository or not webhook.pr_number:
+            return None
+
+        head_sha = None
+        if webhook.pull_request:
+            head_sha = webhook.pull_request.head_sha
+        elif webhook.check_run:
+            head_sha = webhook.check_run.head_sha
+
+        opened = webhook.event_type == 'pull_request' and webhook.action == 'opened'
+        return cls(webhook.repository.full_name, webhook.pr_number, head_sha, webhook.pull_request,
+                   webhook.installation_id, conversation_counts=(0, 0) if opened else None)
+
+    @property
+    def details(self):
+        """The PR as returned by the pulls API (or found in the webhook)."""
+        with self._details_lock:
+            if self._details is None:
+                pr_url = f'repos/{self.repo_full_name}/pulls/{self.pr_number}'
+                self._details = PullRequestView(make_github_api_call(pr_url, 'GET', None, self.installation_id))
+            return self._details
+
+    @property
+    def head_sha(self):
+        return self._head_sha or self.details.head_sha
+
+    @property
+    def knows_head_sha(self):
+        """Whether the head SHA is known without fetching the PR."""
+        return bool(self._head_sha or self._details)
+
+    def missing(self, attributes):
+        """Return which of the given data attributes (details, commits, conversation_counts) are not fetched yet."""
+        fetched = dict(details=self._details, commits=self._commits, conversation_counts=self._conversation_counts)
+        return {attribute for attribute in attributes if fetched[attribute] is None}
+
+    @property
+    def body(self):
+        return self.details.body
+
+    @property
+    def labels(self):
+        return self.details.labels
+
+    @property
+    def commits(self):
+        """The commits of the PR, as returned by the pulls API but only with their `sha` and `commit.message`."""
+        with self._commits_lock:
+            if self._commits is None:
+                self._commits = _get_commits(self.repo_full_name, self.pr_number, self.head_sha,
+                                             self.installation_id)
+            return self._commits
+
+    @property
+    def commit_messages(self):
+        return [str(commit['commit']['message']) for commit in self.commits]
+
+    @property
+    def overrides(self):
+        """The overrides (see constants.OVERRIDE_ALLOWED) used in the commit messages of the PR."""
+        return find_commit_overrides(self.commits)
+
+    @property
+    def conversation_counts(self):
+        """The (resolved, total) review threads of the PR."""
+        with self._threads_lock:
+            if self._conversation_counts is None:
+                self._conversation_counts = get_resolved_and_total_conversations(
+                    self.owner, self.repo, self.pr_number, self.installation_id)
+            return self._conversation_counts
+
+
+def get_resolved_and_total_conversations(owner, repo, pr_number, installation_id=None):
+    """Calculate the resolved and total Request Changes conversations.
+
+    Raise GitHubError if the review threads can't all be read, rather than count only part of them.
+    GraphQL can be examined by the tool provided by Github:  https://developer.github.com/v4/explorer/
+    """
+    query_template = """
+    {
+        repository(owner:"$owner", name:"$repo") {
+            pullRequest(number:$pr_number) {
+                reviewThreads(first: $page_size$after) {
+                    pageInfo {
+                        hasNextPage
+                        endCursor
+                    }
+                    nodes {
+                      isResolved
+                    }
+                }
+            }
+        }
+    }
+    """
+    threads_pages = iter_gql_connection(query_template, dict(owner=owner, repo=repo, pr_number=pr_number),
+                                        ('repository', 'pullRequest', 'reviewThreads'),
+                                        installation_id=installation_id)
+
+    # Count the resolved and unresolved conversations.
+    resolved = total = 0
+    for threads in threads_pages:
+        for thread in threads:
+            total += 1
+            resolved += (1 if thread['isResolved'] else 0)
+
+    return resolved, total
+
+
+def count_conversations_concurrently(owner, repo, pr_numbers, installation_id=None):
+    """Return {pr_number: (resolved, total)} of the PRs, querying them concurrently.
+
+    The PRs whose review threads could not be counted are left out.
+    """
+    pr_numbers = list(pr_numbers)
+    counts = gh_async.run_concurrently(*(
+        functools.partial(get_resolved_and_total_conversations, owner, repo, pr_number, installation_id)
+        for pr_number in pr_numbers), host=gh_async.GQL_HOST, resource=GRAPHQL, installation_id=installation_id,
+        return_exceptions=True)
+
+    failed = {pr_number: count for pr_number, count in zip(pr_numbers, counts) if isinstance(count, Exception)}
+    for pr_number, error in failed.items():
+        log.error(f'Could not count the conversations of {owner}/{repo}#{pr_number}: {error}')
+    return {pr_number: count for pr_number, count in zip(pr_numbers, counts) if pr_number not in failed}
+
+
+def commits_cache_stats():
+    """Return the hits and misses of the commits cache."""
+    with _commits_cache_lock:
+        stats = dict(_counters)
+        stats['size'] = len(_commits_cache)
+    return stats
+
+
+def _get_commits(repo_full_name, pr_number, head_sha, installation_id):
+    # PRs of the same branch into different bases share the head SHA, not the commits.
+    key = (repo_full_name, pr_number, head_sha)
+    now = time.monotonic()
+
+    with _commits_cache_lock:
+        cached = _commits_cache.get(key)
+        if cached and cached[0] + PR_CONTEXT_TTL > now:
+            _commits_cache.move_to_end(key)
+            _counters['hits'] += 1
+            return cached[1]
+        _counters['misses'] += 1
+
+    # Large PRs have long commit lists, only the fields the checks use are decoded.
+    commits_url = f'repos/{repo_full_name}/pulls/{pr_number}/commits'
+    commits = [dict(sha=commit.get('sha'), commit=dict(message=commit.get('commit.message', '')))
+               for commit in iter_github_api_fields(commits_url, ('sha', 'commit.message'),
+                                                    installation_id=installation_id)]
+    if not head_sha:
+        return commits
+
+    with _commits_cache_lock:
+        _commits_cache[key] = (now, commits)
+        _commits_cache.move_to_end(key)
+        while len(_commits_cache) > PR_CONTEXT_CACHE_SIZE:
+            _commits_cache.popitem(last=False)
+
+    return commits
@@ -0,0 +1,81 @@
+import contextlib
+import threading
+
+from bot_config import GH_QUOTA_RESERVE_BACKGROUND, GH_QUOTA_RESERVE_RERUN
+
+"""
+PRIORITY LANES
+===============
+Everything the bot does runs in one of three lanes, most urgent first:
+
+- `interactive`: checks asked for by what a developer just did (a push, a
+  review, a comment),
+- `rerun`: check runs re-requested on GitHub, and journaled jobs run again
+  after a restart,
+- `background`: the conversation scans sweeping every open PR.
+
+The lane is kept per thread: the work queue sets it for the jobs it runs (a job
+is queued in the lane of the code queuing it), and `in_lane` blocks set it
+around other work. The layers below use it so urgent work goes first:
+
+- the work queue runs queued jobs lane by lane, and keeps workers free for
+  interactive jobs,
+- the check publisher writes check runs lane by lane, and
+- GitHub calls of a lane wait while the remaining rate limit is within the
+  share reserved to the more urgent lanes (QUOTA_RESERVES).
+"""
+
+INTERACTIVE = 'interactive'
+RERUN = 'rerun'
+BACKGROUND = 'background'
+# Most urgent first
+LANES = (INTERACTIVE, RERUN, BACKGROUND)
+
+# Lane -> share of a rate limit window it leaves to the more urgent lanes
+QUOTA_RESERVES = {
+    INTERACTIVE: 0.0,
+    RERUN: GH_QUOTA_RESERVE_RERUN,
+    BACKGROUND: GH_QUOTA_RESERVE_BACKGROUND,
+}
+
+_local = threading.local()
+
+
+def current_lane():
+    """Return the lane of the running thread (interactive unless set otherwise)."""
+    return getattr(_local, 'lane', INTERACTIVE)
+
+
+def rank(lane):
+    """Return how urgent a lane is, 0 being the most urgent."""
+    return LANES.index(lane)
+
+
+@contextlib.contextmanager
+def in_lane(lane):
+    """Run the `with` block in the given lane."""
+    previous = current_lane()
+    _local.lane = lane
+    try:
+        yield
+    finally:
+        _local.lane = previous
+
+
+def run_in_lane(lane, func, *args, **kwargs):
+    """Call `func(*args, **kwargs)` in the given lane, e.g. on another thread."""
+    with in_lane(lane):
+        return func(*args, **kwargs)
+
+
+def ensure_thread(thread, name, target, *args):
+    """Return the thread if it is running, otherwise start and return a daemon thread running `target(*args)`.
+
+    The threads of a process don't run in a child forked from it, so the child starts its own.
+    """
+    if thread is not None and thread.is_alive():
+        return thread
+
+    thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+    thread.start()
+    return thread
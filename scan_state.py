@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from bot_config import SCAN_STATE_PATH
+
+log = logging.getLogger(__name__)
+
+"""
+SCAN STATE
+===========
+Remembers what the conversation scan last saw of every PR (head SHA, `updatedAt`
+and resolved/total counts) plus a per repo cursor, so a scan only looks at PRs
+updated since the previous one and only sets a check when something changed.
+
+The state is kept in memory and written to SCAN_STATE_PATH after each scan.
+"""
+
+# (repo_full_name, pr_number) -> dict(head_sha, updated_at, resolved, total)
+_prs = {}
+# repo_full_name -> dict(updated_at, full_scan_at)
+_cursors = {}
+_lock = threading.Lock()
+_loaded = False
+
+
+def get_cursor(repo_full_name):
+    """Return the `updatedAt` of the most recently updated PR seen by the last scan, if any."""
+    _load()
+    with _lock:
+        return _cursors.get(repo_full_name, {}).get('updated_at')
+
+
+def needs_full_scan(repo_full_name, interval):
+    """Tell whether the repo was not fully scanned within the last `interval` seconds."""
+    _load()
+    with _lock:
+        full_scan_at = _cursors.get(repo_full_name, {}).get('full_scan_at', 0)
+    return full_scan_at + interval <= time.time()
+
+
+def record_result(repo_full_name, pr_number, head_sha, updated_at, resolved, total):
+    """Remember the scan result of a PR. Return True if the head SHA or the result changed."""
+    _load()
+    key = (repo_full_name, str(pr_number))
+    state = dict(head_sha=head_sha, updated_at=updated_at, resolved=resolved, total=total)
+
+    with _lock:
+        previous = _prs.get(key)
+        _prs[key] = state
+
+    return previous is None or (previous['head_sha'], previous['resolved'], previous['total']) != \
+        (head_sha, resolved, total)
+
+
+def finish_scan(repo_full_name, newest_updated_at, full_scan, seen_pr_numbers=()):
+    """Move the cursor of a repo after a scan, forgetting closed PRs after a full one, and save the state."""
+    _load()
+    with _lock:
+        cursor = _cursors.setdefault(repo_full_name, {})
+        if newest_updated_at and newest_updated_at > (cursor.get('updated_at') or ''):
+            cursor['updated_at'] = newest_updated_at
+
+        if full_scan:
+            cursor['full_scan_at'] = time.time()
+            seen = {str(pr_number) for pr_number in seen_pr_numbers}
+            for key in [key for key in _prs if key[0] == repo_full_name and key[1] not in seen]:
+                del _prs[key]
+
+    save()
+
+
+def save():
+    """Write the state to SCAN_STATE_PATH."""
+    if not SCAN_STATE_PATH:
+        return
+
+    with _lock:
+        state = dict(prs=[dict(repo=key[0], pr_number=key[1], **value) for key, value in _prs.items()],
+                     cursors=_cursors)
+        serialized = json.dumps(state)
+
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(SCAN_STATE_PATH) or '.', prefix='.scan_state.')
+        with os.fdopen(fd, 'w') as state_file:
+            state_file.write(serialized)
+        os.replace(temp_path, SCAN_STATE_PATH)
+
+    except Exception as exc:
+        log.error(f'Could not write scan state.\n{exc}')
+        traceback.print_exc(file=sys.stderr)
+
+
+def _load():
+    global _loaded
+
+    if _loaded:
+        return
+
+    with _lock:
+        if _loaded:
+            return
+        _loaded = True
+
+        if not SCAN_STATE_PATH or not os.path.exists(SCAN_STATE_PATH):
+            return
+
+        try:
+            with open(SCAN_STATE_PATH) as state_file:
+                state = json.loads(state_file.read())
+
+            for pr in state.get('prs', []):
+                key = (pr.pop('repo'), pr.pop('pr_number'))
+                _prs[key] = pr
+            _cursors.update(state.get('cursors', {}))
+
+        except Exception as exc:
+            log.error(f'Could not read scan state, starting from scratch.\n{exc}')
+            traceback.print_exc(file=sys.stderr)
@@ -0,0 +1,85 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from bot_config import SHARED_STATE_PATH
+
+"""
+SHARED STORE
+=============
+A small SQLite database shared by the processes of the bot (e.g. the workers of
+the production server) at SHARED_STATE_PATH, for the state each of them would
+otherwise keep on its own, like installation tokens and handled deliveries.
+
+Every process opens its own connection (a forked child opens a new one), used
+by one thread at a time. WAL journaling lets the processes read while one of
+them writes. The database is only readable by its owner, as it holds tokens.
+"""
+
+# path -> (connection, lock), of this process
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def enabled(path=SHARED_STATE_PATH):
+    return bool(path)
+
+
+@contextlib.contextmanager
+def transaction(path=SHARED_STATE_PATH):
+    """Yield the connection to the database, committing the block's changes (or rolling them back on error)."""
+    connection, lock = _connect(path)
+    with lock, connection:
+        yield connection
+
+
+def get(namespace, key, path=SHARED_STATE_PATH):
+    """Return the value stored under the key, or None if there is none or it expired."""
+    with transaction(path) as connection:
+        row = connection.execute('SELECT value FROM kv WHERE namespace = ? AND key = ? AND '
+                                 '(expires_at IS NULL OR expires_at > ?)', (namespace, key, time.time())).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def put(namespace, key, value, expires_at=None, path=SHARED_STATE_PATH):
+    """Store a JSON serializable value under the key, until `expires_at` (epoch seconds) if given."""
+    with transaction(path) as connection:
+        connection.execute('INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                           (namespace, key, json.dumps(value), expires_at))
+
+
+def items(namespace, path=SHARED_STATE_PATH):
+    """Return {key: value} of the values of a namespace that did not expire."""
+    with transaction(path) as connection:
+        rows = connection.execute('SELECT key, value FROM kv WHERE namespace = ? AND '
+                                  '(expires_at IS NULL OR expires_at > ?)', (namespace, time.time())).fetchall()
+    return {key: json.loads(value) for key, value in rows}
+
+
+def _connect(path):
+    with _connections_lock:
+        if path not in _connections:
+            if not os.path.exists(path):
+                # Created by hand so it is private, the WAL files SQLite adds get the same permissions.
+                os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+
+            connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                               'value TEXT NOT NULL, expires_at REAL, PRIMARY KEY (namespace, key))')
+            connection.commit()
+            _connections[path] = (connection, threading.Lock())
+
+        return _connections[path]
+
+
+def _reset_after_fork():
+    # SQLite connections must not be used across a fork, the child opens its own.
+    _connections.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,69 @@
+import collections
+import threading
+
+import pytest
+
+import check_publisher
+
+from priority import BACKGROUND, in_lane
+
+CHECK = ('owner/repo', 'Conversation Resolution')
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """Publisher state starting empty. Return the (thread name, conclusion, check run id) writes sent."""
+    monkeypatch.setattr(check_publisher, '_pending', {})
+    monkeypatch.setattr(check_publisher, '_published', collections.OrderedDict())
+    monkeypatch.setattr(check_publisher, '_writing', set())
+
+    sent = []
+
+    def set_check_on_pr(repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title,
+                        output_summary, installation_id, check_run_id=None):
+        sent.append((threading.current_thread().name, check_conclusion, check_run_id))
+        return {'id': 7}
+
+    monkeypatch.setattr(check_publisher, 'set_check_on_pr', set_check_on_pr)
+    yield sent
+    assert check_publisher.flush(5)
+
+
+def _publish(conclusion, head_sha='sha1'):
+    check_publisher.publish_check(*CHECK, 'completed', conclusion, head_sha, 'title', conclusion)
+
+
+def test_background_writes_use_background_threads(writes):
+    with in_lane(BACKGROUND):
+        _publish('success')
+    assert check_publisher.flush(5)
+
+    assert [(name.startswith('check-publisher-background-'), conclusion) for name, conclusion, _ in writes] == \
+        [(True, 'success')]
+
+
+def test_interactive_write_is_handed_over_by_background_thread(monkeypatch, writes):
+    writing = threading.Event()
+    resume = threading.Event()
+    set_check_on_pr = check_publisher.set_check_on_pr
+
+    def slow_set_check_on_pr(*args, **kwargs):
+        if not writing.is_set():
+            writing.set()
+            assert resume.wait(5)
+        return set_check_on_pr(*args, **kwargs)
+
+    monkeypatch.setattr(check_publisher, 'set_check_on_pr', slow_set_check_on_pr)
+
+    with in_lane(BACKGROUND):
+        _publish('success')
+    assert writing.wait(5)
+    # Published while the background thread writes the same check run.
+    _publish('failure')
+    resume.set()
+    assert check_publisher.flush(5)
+
+    (first_thread, first, first_id), (second_thread, second, second_id) = writes
+    assert first_thread.startswith('check-publisher-background-') and (first, first_id) == ('success', None)
+    # An interactive thread updates the check run the background thread created.
+    assert not second_thread.startswith('check-publisher-background-') and (second, second_id) == ('failure', 7)
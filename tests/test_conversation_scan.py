@@ -0,0 +1,150 @@
+import time
+
+import pytest
+
+import gh_utils
+import policy_engine
+import pr_context
+import scan_state
+import webhook_handlers
+
+from gh_utils import GitHubError
+from pr_context import PullRequestContext
+
+REPO = 'owner/repo'
+
+
+def _pull_request(number, updated_at, resolved=0, total=0, fetched=None):
+    fetched = total if fetched is None else fetched
+    return {'number': number, 'headRefOid': f'sha{number}', 'updatedAt': updated_at,
+            'reviewThreads': {'totalCount': total, 'nodes': [{'isResolved': index < resolved}
+                                                             for index in range(fetched)]}}
+
+
+def _page(*pull_requests, end_cursor=None, cost=1):
+    return {'data': {'repository': {'pullRequests': {
+        'nodes': list(pull_requests), 'pageInfo': {'hasNextPage': bool(end_cursor), 'endCursor': end_cursor}}},
+        'rateLimit': {'cost': cost}}}
+
+
+@pytest.fixture
+def published(monkeypatch):
+    """Scan state kept in memory only and starting empty. Return the (pr head SHA, conclusion) published."""
+    monkeypatch.setattr(scan_state, 'SCAN_STATE_PATH', '')
+    monkeypatch.setattr(scan_state, '_prs', {})
+    monkeypatch.setattr(scan_state, '_cursors', {})
+    monkeypatch.setattr(scan_state, '_loaded', True)
+
+    checks = []
+    monkeypatch.setattr(webhook_handlers, 'publish_check',
+                        lambda repo, name, status, conclusion, head_sha, *args: checks.append((head_sha, conclusion)))
+    return checks
+
+
+def _respond(monkeypatch, *responses):
+    """Answer the scan's GraphQL queries with the given responses, in order."""
+    responses = iter(responses)
+    monkeypatch.setattr(webhook_handlers, 'make_github_gql_api_call', lambda query: next(responses))
+
+
+def _scanned_recently(updated_at=None):
+    scan_state._cursors[REPO] = dict(updated_at=updated_at, full_scan_at=time.time())
+
+
+def test_completed_scan_moves_cursor(monkeypatch, published):
+    _respond(monkeypatch, _page(_pull_request(2, '2026-01-02T00:00:00Z'), end_cursor='next'),
+             _page(_pull_request(1, '2026-01-01T00:00:00Z', resolved=1, total=2)))
+
+    webhook_handlers.run_conversation_check_scan_for_prs('owner', 'repo')
+
+    assert published == [('sha2', 'success'), ('sha1', 'failure')]
+    assert scan_state.get_cursor(REPO) == '2026-01-02T00:00:00Z'
+    assert not scan_state.needs_full_scan(REPO, 600)
+
+
+def test_failed_query_keeps_cursor(monkeypatch, published):
+    scan_state._cursors[REPO] = dict(updated_at='2026-01-01T00:00:00Z', full_scan_at=0)
+    _respond(monkeypatch, _page(_pull_request(2, '2026-01-02T00:00:00Z'), end_cursor='next'),
+             {'errors': [{'message': 'Something went wrong'}]})
+
+    webhook_handlers.run_conversation_check_scan_for_prs('owner', 'repo')
+
+    assert published == [('sha2', 'success')]
+    assert scan_state.get_cursor(REPO) == '2026-01-01T00:00:00Z'
+    assert scan_state.needs_full_scan(REPO, 600)
+
+
+def test_spent_cost_budget_keeps_cursor(monkeypatch, published):
+    _scanned_recently('2026-01-01T00:00:00Z')
+    _respond(monkeypatch, _page(_pull_request(2, '2026-01-02T00:00:00Z'), end_cursor='next', cost=1000))
+
+    webhook_handlers.run_conversation_check_scan_for_prs('owner', 'repo')
+
+    assert published == [('sha2', 'success')]
+    assert scan_state.get_cursor(REPO) == '2026-01-01T00:00:00Z'
+
+
+def test_uncounted_overflowing_pr_is_skipped_and_keeps_cursor(monkeypatch, published):
+    def fail(*args, **kwargs):
+        raise GitHubError('Could not read repository.pullRequest.reviewThreads')
+
+    # The PR has more review threads than fetched along, and counting them on their own fails.
+    monkeypatch.setattr(pr_context, 'iter_gql_connection', fail)
+    _respond(monkeypatch, _page(_pull_request(2, '2026-01-02T00:00:00Z', resolved=2, total=5, fetched=2),
+                                _pull_request(1, '2026-01-01T00:00:00Z')))
+
+    webhook_handlers.run_conversation_check_scan_for_prs('owner', 'repo')
+
+    assert published == [('sha1', 'success')]
+    assert scan_state.get_cursor(REPO) is None
+    assert scan_state.needs_full_scan(REPO, 600)
+
+
+def test_incremental_scan_skips_unchanged_results(monkeypatch, published):
+    scan_state.record_result(REPO, '1', 'sha1', '2026-01-01T00:00:00Z', 0, 0)
+    _scanned_recently()
+    _respond(monkeypatch, _page(_pull_request(2, '2026-01-02T00:00:00Z'), _pull_request(1, '2026-01-01T00:00:00Z')))
+
+    webhook_handlers.run_conversation_check_scan_for_prs('owner', 'repo')
+
+    assert published == [('sha2', 'success')]
+
+
+def test_full_scan_publishes_unchanged_results(monkeypatch, published):
+    # Recorded by a scan whose write may have failed since.
+    scan_state.record_result(REPO, '1', 'sha1', '2026-01-01T00:00:00Z', 0, 0)
+    _respond(monkeypatch, _page(_pull_request(1, '2026-01-01T00:00:00Z')))
+
+    webhook_handlers.run_conversation_check_scan_for_prs('owner', 'repo')
+
+    assert published == [('sha1', 'success')]
+
+
+def test_unbatched_scan_with_uncounted_pr_is_incomplete(monkeypatch, published):
+    monkeypatch.setattr(webhook_handlers, 'get_sha', lambda owner, repo: {'1': 'sha1', '2': 'sha2'})
+    monkeypatch.setattr(webhook_handlers, 'count_conversations_concurrently',
+                        lambda owner, repo, pr_numbers: {'1': (0, 1)})
+
+    webhook_handlers.run_conversation_check_scan_for_prs('owner', 'repo', batched=False)
+
+    assert published == [('sha1', 'failure')]
+    assert scan_state.needs_full_scan(REPO, 600)
+
+
+@pytest.mark.parametrize('response, conclusions', [
+    ({'data': {'repository': {'pullRequest': {'reviewThreads': {
+        'nodes': [{'isResolved': True}], 'pageInfo': {'hasNextPage': False, 'endCursor': None}}}}}},
+     [('Conversation Resolution', 'success')]),
+    # Unreadable review threads are not taken for none.
+    ({'errors': [{'message': 'Something went wrong'}]}, []),
+    ({'data': {'repository': None}}, []),
+])
+def test_conversation_resolution_policy(monkeypatch, response, conclusions):
+    monkeypatch.setattr(gh_utils, 'make_github_gql_api_call', lambda query, installation_id=None: response)
+    checks = []
+    monkeypatch.setattr(policy_engine, 'publish_checks', checks.extend)
+
+    context = PullRequestContext(REPO, 1, head_sha='sha1', installation_id=1)
+    policy_engine.run(context, ['Conversation Resolution'])
+
+    assert [(name, conclusion) for _, name, _, conclusion, *_ in checks] == conclusions
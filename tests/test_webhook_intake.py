@@ -0,0 +1,66 @@
+import hashlib
+import hmac
+
+import pytest
+
+import webhook_intake
+
+SECRET = b'webhook-secret'
+BODY = b'{"action": "opened", "number": 1}'
+
+
+def _signature(body, secret=SECRET):
+    return 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    monkeypatch.setattr(webhook_intake, '_secret', SECRET)
+
+
+def test_good_signature_is_accepted(secret):
+    assert webhook_intake.verify_signature(BODY, _signature(BODY))
+
+
+@pytest.mark.parametrize('signature', [
+    _signature(BODY, b'other-secret'),
+    _signature(BODY + b' '),
+    _signature(BODY).replace('sha256=', 'sha1='),
+    'sha256=',
+])
+def test_bad_signature_is_rejected(secret, signature):
+    assert not webhook_intake.verify_signature(BODY, signature)
+
+
+@pytest.mark.parametrize('signature', [None, ''])
+def test_missing_signature_is_rejected(secret, signature):
+    assert not webhook_intake.verify_signature(BODY, signature)
+
+
+def test_signature_is_not_checked_without_secret(monkeypatch):
+    monkeypatch.setattr(webhook_intake, '_secret', None)
+    assert webhook_intake.verify_signature(BODY, None)
+
+
+@pytest.mark.parametrize('body, action', [
+    (b'{"action": "opened", "number": 1}', 'opened'),
+    (b'\n {\n  "action" : "Synchronize"}', 'synchronize'),
+    (b'{"number": 1, "action": "opened"}', None),
+    (b'{"action": "op\\"ened"}', None),
+    (b'', None),
+])
+def test_sniff_action(body, action):
+    assert webhook_intake.sniff_action(body) == action
+
+
+@pytest.mark.parametrize('event_type, body, wanted', [
+    ('pull_request', b'{"action": "opened"}', True),
+    ('pull_request', b'{"action": "closed"}', False),
+    # The action can't be told without decoding, the delivery is let through.
+    ('pull_request', b'{"number": 1, "action": "closed"}', True),
+    ('pull_request_review', b'{"action": "dismissed"}', True),
+    ('issue_comment', b'{"action": "deleted"}', False),
+    ('push', b'{"ref": "refs/heads/master"}', False),
+])
+def test_is_wanted(event_type, body, wanted):
+    assert webhook_intake.is_wanted(event_type, body) is wanted
@@ -1,155 +1,56 @@
 import collections
 import logging
-from constants import OVERRIDE_ALLOWED
-from gh_utils import make_github_api_call, make_github_gql_api_call, set_check_on_pr, format_query
+import math
+import metrics
+import policy_engine
+import scan_state
 
-
-from objectify_json import ObjectifyJSON
+from bot_config import GQL_SCAN_BATCH_SIZE, GQL_SCAN_COST_BUDGET, GQL_SCAN_THREADS_PER_PR, \
+    SCAN_FULL_RESCAN_INTERVAL
+from check_publisher import publish_check
+from gh_utils import make_github_api_call, make_github_gql_api_call, format_query, iter_github_api_items
+from policies import conversation_result
+from pr_context import PullRequestContext, count_conversations_concurrently
 
 
 log = logging.getLogger(__name__)
 
 
-def pr_template_check(webhook):
-    repo_full_name = str(webhook.repository.full_name)
-
-    check_name = 'PR Basic Information Check'
-    check_status = 'completed'
-
-    # It could be either from run or re-run
-    if webhook.pull_request:
-        head_sha = str(webhook.pull_request.head.sha)
-        description = str(webhook.pull_request.body)
-    else:
-        head_sha = str(webhook.check_run.head_sha)
-        pr_url = f'repos/{repo_full_name}/pulls/{webhook.check_run.pull_requests[0].number}'
-        pr_info = ObjectifyJSON(make_github_api_call(pr_url, 'GET', None))
-        description = str(pr_info.body)
-
-    # TODO: needs tweaking
-    if len(description) >= 5:
-        check_conclusion = 'success'
-        output_title = 'Required information has been filed'
-        output_summary = 'Required information of this pull request has been filled.'
-    else:
-        check_conclusion = 'failure'
-        output_title = 'Required information is still missing'
-        output_summary = 'Please make sure the Pull Request Description section is filled.'
-
-    set_check_on_pr(repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title, output_summary)
-
-
-def check_trunk_status(webhook):
-    # TODO: needs to be improved
-    return
-    repo_full_name = str(webhook.repository.full_name)
-
-    check_name = 'Multiproduct Trunk Status'
-    check_status = 'completed'
-
-    # It could be either from run or re-run
-    if webhook.pull_request:
-        pr_number = str(webhook.pull_request.number)
-        head_sha = str(webhook.pull_request.head.sha)
-    else:
-        pr_number = str(webhook.check_run.pull_requests[0].number)
-        head_sha = str(webhook.check_run.head_sha)
-
-    commits_url = f'repos/{repo_full_name}/pulls/{pr_number}/commits'
-    commits = ObjectifyJSON(make_github_api_call(commits_url, 'GET', None))
-
-    commit_messages = [str(commit['commit']['message']) for commit in commits]
-    found_override = any(['TRUNKBLOCKERFIX' in commit_message for commit_message in commit_messages])
-
-    check_conclusion = 'failure'
-    output_title = 'MP locked, merge not allowed'
-    output_summary = '''MP locked by owners of this Multiproduct. No new merges are allowed at this time.
-    You may override this check by adding string `TRUNKBLOCKERFIX` to the comment message and sync the commit to Github.
-    Doing so will notify the owners of this merge. Read more about MP lock policy [here](https://iwww.corp.linkedin.com/wiki/cf/display/TOOLS/questions/184796939/what-is-the-recommended-way-to-lock-checkins-to-multiproduct).
-    '''
-
-    if found_override:
-        check_conclusion = 'success'
-        output_title = 'MP lock overridden'
-        output_summary = '''Forced status check to success via `TRUNKBLOCKERFIX` override.
-        More information about this override can be found [here](https://iwww.corp.linkedin.com/wiki/cf/display/TOOLS/Multiproduct+Trunk+Development#MultiproductTrunkDevelopment-TRUNKBLOCKERFIX).
-        '''
-
-    set_check_on_pr(repo_full_name, check_name, check_status, check_conclusion, head_sha, output_title, output_summary)
-
-
-def check_conversation_resolution(webhook):
-    repo_full_name = str(webhook.repository.full_name)
-    owner = repo_full_name.split('/')[0]
-    repo = repo_full_name.split('/')[1]
-    pr_number = None
-
-    check_name = 'Conversation Resolution'
-    head_sha = None
-    output_title = None
-    output_summary = None
-
-    # Just created a new PR, will not have any reviews.
-    if str(webhook.action) == 'opened':
-        head_sha = str(webhook.pull_request.head.sha)
-        output_title = 'There are no unresolved conversations'
-        output_summary = 'Check passed as there are no unresolved conversations on this pull request.'
-        set_check_on_pr(repo_full_name, check_name, 'completed', 'success', head_sha, output_title, output_summary)
+@metrics.timed('bot_handler_duration_seconds')
+def run_policies(webhook, context=None, policy_names=()):
+    """Evaluate the named policies (see policies.py) on the PR of the webhook and publish their check runs."""
+    context = context or PullRequestContext.from_webhook(webhook)
+    if not context:
         return
 
-    # PR edit
-    if webhook.pull_request.head.sha:
-        pr_number = str(webhook.pull_request.number)
-        head_sha = str(webhook.pull_request.head.sha)
-
-    # Comment
-    elif webhook.issue and webhook.issue.pull_request and webhook.comment:
-        pr_url = f'repos/{repo_full_name}/pulls/{webhook.issue.number}'
-        pr_info = ObjectifyJSON(make_github_api_call(pr_url, 'GET', None))
-        pr_number = str(webhook.issue.number)
-        head_sha = str(pr_info.head.sha)
-
-    # Re-run
-    elif webhook.check_run and webhook.check_run.pull_requests:
-        pr_number = str(webhook.check_run.pull_requests[0].number)
-        head_sha = str(webhook.check_run.head_sha)
-
-    # Incomplete info, give up
-    if not pr_number or not head_sha:
-        return
+    policy_engine.run(context, policy_names)
 
-    set_check_on_pr(repo_full_name, check_name, 'in_progress', None, head_sha, output_title, output_summary)
 
-    resolved, total = _get_resolved_and_total_conversations(owner, repo, pr_number)
+def set_conversation_result_check(resolved, total, repo_full_name, check_name, head_sha, installation_id=None):
+    result = conversation_result(resolved, total)
+    publish_check(repo_full_name, check_name, 'completed', result.conclusion, head_sha, result.title, result.summary,
+                  installation_id)
 
-    set_conversation_result_check(resolved, total, repo_full_name, check_name, head_sha)
-
-
-def set_conversation_result_check(resolved, total, repo_full_name, check_name, head_sha):
-    if resolved == total:
-        check_conclusion = 'success'
-        output_title = 'There are no unresolved conversations'
-        output_summary = 'Check passed as there are no unresolved conversations on this pull request.'
-    else:
-        check_conclusion = 'failure'
-        output_title = f'{resolved}/{total} conversations resolved'
-        output_summary = f'Check failed because only {resolved}/{total} conversations resolved. ' \
-                         f'Please handle the unresolved one(s).\n' \
-                         f'To refresh this check, re-run manually or wait for the next automated run in 1 minute. \n\n' \
-                         f'More information about how the check is conducted can be found [here](https://linkedin.com/).'
-    set_check_on_pr(repo_full_name, check_name, 'completed', check_conclusion, head_sha, output_title, output_summary)
 
+def get_sha(owner, repo):
+    pull_requests = iter_github_api_items(f'repos/{owner}/{repo}/pulls')
+    return {str(pull_request['number']): str(pull_request['head']['sha']) for pull_request in pull_requests}
 
-def _get_resolved_and_total_conversations(owner, repo, pr_number):
-    """Calculate the resolved and total Request Changes conversations.
 
-    GraphQL can be examined by the tool provided by Github:  https://developer.github.com/v4/explorer/
-    """
-    query = format_query("""
-    {
-        repository(owner:"$owner", name:"$repo") {
-            pullRequest(number:$pr_number) {
-                reviewThreads(last: 50) {
+_OPEN_PULL_REQUESTS_QUERY = """
+{
+    repository(owner:"$owner", name:"$repo") {
+        pullRequests(states: OPEN, first: $batch_size$after, orderBy: {field: UPDATED_AT, direction: DESC}) {
+            pageInfo {
+                hasNextPage
+                endCursor
+            }
+            nodes {
+                number
+                headRefOid
+                updatedAt
+                reviewThreads(first: $threads_per_pr) {
+                    totalCount
                     nodes {
                       isResolved
                     }
@@ -157,53 +58,146 @@ def _get_resolved_and_total_conversations(owner, repo, pr_number):
             }
         }
     }
-    """, dict(owner=owner, repo=repo, pr_number=pr_number))
+    rateLimit {
+        cost
+        remaining
+    }
+}
+"""
 
-    response = ObjectifyJSON(make_github_gql_api_call(query))
 
-    # Count the resolved and unresolved conversations.
-    resolved = total = 0
-    for node in response.data.repository.pullRequest.reviewThreads.nodes._data:
-        total += 1
-        resolved += (1 if node['isResolved'] else 0)
+def get_open_pr_conversations(owner, repo, updated_since=None, batch_size=GQL_SCAN_BATCH_SIZE,
+                              threads_per_pr=GQL_SCAN_THREADS_PER_PR, cost_budget=GQL_SCAN_COST_BUDGET):
+    """Yield (pr_number, head_sha, resolved, total, updated_at) of every open PR, most recently updated first,
+    fetching a batch of PRs per GraphQL query.
 
-    return resolved, total
+    With `updated_since` (an `updatedAt` timestamp) the PRs updated before it are skipped.
+    PRs with more review threads than fetched along with the batch are counted with a query of their own.
+    The scan stops early once the next query would take it over the GraphQL cost budget, or when a query fails.
+    PRs whose review threads could not be counted are left out.
+    Return whether every PR was listed, False when the scan stopped early or left PRs out.
+    """
+    batch_size = min(max(batch_size, 1), 100)
+    threads_per_pr = min(max(threads_per_pr, 1), 100)
+    # GitHub charges a point per 100 connections requested: the page of PRs plus the review threads of each PR.
+    estimated_cost = math.ceil((1 + batch_size) / 100)
+
+    spent = 0
+    after = ''
+    listed_all = True
+    while True:
+        if spent + estimated_cost > cost_budget:
+            log.warning(f'Stopping conversation scan of {owner}/{repo}, GraphQL cost budget of {cost_budget} spent.')
+            return False
+
+        query = format_query(_OPEN_PULL_REQUESTS_QUERY, dict(owner=owner, repo=repo, batch_size=batch_size,
+                                                             threads_per_pr=threads_per_pr, after=after))
+        response = make_github_gql_api_call(query) or {}
+        data = response.get('data') or {}
+        if not data.get('repository'):
+            log.error(f'Could not list open PRs of {owner}/{repo}: {response.get("errors")}')
+            return False
+
+        spent += (data.get('rateLimit') or {}).get('cost', estimated_cost)
+
+        pull_requests = data['repository']['pullRequests']
+        nodes = [pull_request for pull_request in pull_requests['nodes']
+                 if not updated_since or pull_request['updatedAt'] >= updated_since]
+
+        # The PRs of the batch with too many threads to fetch along are counted concurrently.
+        overflowing = [str(pull_request['number']) for pull_request in nodes
+                       if pull_request['reviewThreads']['totalCount'] > len(pull_request['reviewThreads']['nodes'])]
+        overflow_counts = count_conversations_concurrently(owner, repo, overflowing) if overflowing else {}
+
+        for pull_request in nodes:
+            pr_number = str(pull_request['number'])
+            threads = pull_request['reviewThreads']
+            if pr_number in overflow_counts:
+                resolved, total = overflow_counts[pr_number]
+            elif pr_number in overflowing:
+                # Counting only the threads fetched along would undercount them.
+                listed_all = False
+                continue
+            else:
+                resolved = sum(1 for thread in threads['nodes'] if thread['isResolved'])
+                total = len(threads['nodes'])
+
+            yield pr_number, pull_request['headRefOid'], resolved, total, pull_request['updatedAt']
+
+        # PRs come most recently updated first, the rest were updated before `updated_since`.
+        if len(nodes) < len(pull_requests['nodes']) or not pull_requests['pageInfo']['hasNextPage']:
+            return listed_all
+        after = f', after: "{pull_requests["pageInfo"]["endCursor"]}"'
+
+
+@metrics.timed('bot_scan_duration_seconds')
+def run_conversation_check_scan_for_prs(owner, repo, batched=True, incremental=True):
+    """Set the conversation resolution check on open PRs.
+
+    The batched scan fetches many PRs per GraphQL query, otherwise every PR is queried on its own.
+    An incremental scan only looks at PRs updated since the previous scan (with a full scan every
+    SCAN_FULL_RESCAN_INTERVAL seconds, as resolving a thread does not always bump `updatedAt`) and
+    only sets the check when the head SHA or the result changed. A full scan sets it on every PR, so a write
+    that failed since is retried (the check publisher skips the ones identical to what it published).
+    A scan that stopped early leaves the cursor where it was, so the PRs it did not get to are looked at by
+    the next one.
+    """
+    check_name = 'Requested Changes Resolution'
+    repo_full_name = f'{owner}/{repo}'
 
+    full_scan = not incremental or not batched or scan_state.needs_full_scan(repo_full_name,
+                                                                             SCAN_FULL_RESCAN_INTERVAL)
+    completed = True
 
-def get_sha(owner, repo):
-    pull_requests = ObjectifyJSON(make_github_api_call(f'repos/{owner}/{repo}/pulls'))
-    return {str(pull_request['number']): str(pull_request['head']['sha']) for pull_request in pull_requests}
+    def listed(pr_conversations):
+        nonlocal completed
+        completed = yield from pr_conversations
 
+    if batched:
+        updated_since = None if full_scan else scan_state.get_cursor(repo_full_name)
+        pr_conversations = listed(get_open_pr_conversations(owner, repo, updated_since=updated_since))
+    else:
+        pr_shas = get_sha(owner, repo)
+        counts = count_conversations_concurrently(owner, repo, list(pr_shas))
+        completed = len(counts) == len(pr_shas)
+        pr_conversations = ((pr_number, sha) + counts[pr_number] + (None,) for pr_number, sha in pr_shas.items()
+                            if pr_number in counts)
+
+    newest_updated_at = None
+    seen_pr_numbers = []
+    for pr_number, sha, resolved, total, updated_at in pr_conversations:
+        seen_pr_numbers.append(pr_number)
+        newest_updated_at = max(newest_updated_at or '', updated_at or '') or None
+
+        changed = scan_state.record_result(repo_full_name, pr_number, sha, updated_at, resolved, total)
+        if incremental and not full_scan and not changed:
+            continue
 
-def run_conversation_check_scan_for_prs(owner, repo):
-    pr_shas = get_sha(owner, repo)
-    check_name = 'Requested Changes Resolution'
-    for pr_number, sha in pr_shas.items():
-        resolved, total = _get_resolved_and_total_conversations(owner, repo, pr_number)
         log.info(f'Setting conversation resolution status ({resolved}/{total}, '
                  f'for PR: {owner}/{repo}/{pr_number} at {sha}')
-        set_conversation_result_check(resolved, total, f'{owner}/{repo}', check_name, sha)
+        set_conversation_result_check(resolved, total, repo_full_name, check_name, sha)
 
+    # Unless every PR was listed and counted, the cursor and the state of the PRs not seen stay as they were.
+    if completed:
+        scan_state.finish_scan(repo_full_name, newest_updated_at, full_scan, seen_pr_numbers)
+    else:
+        scan_state.save()
 
-def process_override(webhook):
-    repo_full_name = str(webhook.repository.full_name)
-    pr_number = str(webhook.pull_request.number)
 
-    commits_url = f'repos/{repo_full_name}/pulls/{pr_number}/commits'
-    commits = ObjectifyJSON(make_github_api_call(commits_url, 'GET', None))
+@metrics.timed('bot_handler_duration_seconds')
+def process_override(webhook, context=None):
+    context = context or PullRequestContext.from_webhook(webhook)
+    repo_full_name = context.repo_full_name
+    pr_number = context.pr_number
 
-    override_used = set()
-    commit_messages = [str(commit['commit']['message']) for commit in commits]
-    for commit_message in commit_messages:
-        for allowed_override in OVERRIDE_ALLOWED:
-            if allowed_override in commit_message:
-                override_used.add(allowed_override)
+    override_used = context.overrides
 
     label_url = f'repos/{repo_full_name}/issues/{pr_number}/labels'
     make_github_api_call(
         label_url,
         'POST', {
             'labels': list(override_used)
-        }
+        },
+        context.installation_id
     )
     log.info(f'labels: {override_used} applied')
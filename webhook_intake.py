@@ -0,0 +1,59 @@
+import hashlib
+import hmac
+import logging
+import re
+
+from bot_config import GH_WEBHOOK_SECRET
+from event_router import handles
+
+log = logging.getLogger(__name__)
+
+"""
+WEBHOOK INTAKE
+===============
+The cheap checks a delivery goes through before its payload is decoded, so the
+deliveries the bot would drop anyway cost as little as possible:
+
+1. its `X-GitHub-Event` must be one the bot handles,
+2. the `action` sniffed from the start of the raw payload (when found there)
+   must be one the bot handles for that event, and
+3. its `X-Hub-Signature-256` must be the HMAC-SHA256 of the raw payload with
+   GH_WEBHOOK_SECRET, compared in constant time.
+
+Without a GH_WEBHOOK_SECRET signatures are not checked.
+"""
+
+# GitHub puts `action` first in the payload, so looking at the first bytes is enough (and cheap)
+_ACTION_SNIFF_BYTES = 256
+_ACTION_PATTERN = re.compile(rb'^\s*{\s*"action"\s*:\s*"([^"\\]*)"')
+
+_secret = GH_WEBHOOK_SECRET.encode('utf-8') if isinstance(GH_WEBHOOK_SECRET, str) and GH_WEBHOOK_SECRET else None
+if _secret is None:
+    log.warning('GH_WEBHOOK_SECRET is not set, webhook signatures are not verified.')
+
+
+def sniff_action(body):
+    """Return the `action` of a raw payload if it is its first key, None if it can't be told without decoding."""
+    match = _ACTION_PATTERN.match(body[:_ACTION_SNIFF_BYTES])
+    return match.group(1).decode('utf-8').lower() if match else None
+
+
+def is_wanted(event_type, body):
+    """Tell whether the bot may handle a delivery, judging by its event type and sniffed action only."""
+    if not handles(event_type):
+        return False
+
+    action = sniff_action(body)
+    return action is None or handles(event_type, action)
+
+
+def verify_signature(body, signature):
+    """Tell whether the `X-Hub-Signature-256` header matches the raw payload (always True without a secret)."""
+    if _secret is None:
+        return True
+
+    if not signature or not signature.startswith('sha256='):
+        return False
+
+    expected = 'sha256=' + hmac.new(_secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
@@ -0,0 +1,152 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from bot_config import WEBHOOK_BACKGROUND_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_RESERVED_WORKERS, WEBHOOK_WORKERS
+from priority import BACKGROUND, INTERACTIVE, LANES, current_lane, in_lane
+
+log = logging.getLogger(__name__)
+
+"""
+WEBHOOK WORK QUEUE
+===================
+The webhook receiver only validates a delivery and puts it on a bounded queue;
+a pool of worker threads runs the (slow, API heavy) handlers afterwards.
+
+When the queue is full `submit` refuses the job instead of blocking, so the
+receiver can answer right away and GitHub gets a quick response either way.
+
+Jobs are queued per priority lane (see priority.py), each lane holding up to
+WEBHOOK_QUEUE_SIZE jobs, and a free worker takes the oldest job of the most
+urgent lane. WEBHOOK_RESERVED_WORKERS workers are kept for interactive jobs,
+and background jobs use at most WEBHOOK_BACKGROUND_WORKERS workers, so a
+developer's check never waits behind a sweep.
+"""
+
+# lane -> deque of (func, args, kwargs)
+_jobs = {lane: collections.deque() for lane in LANES}
+# lane -> workers running a job of the lane
+_busy = collections.Counter()
+_unfinished = 0
+_workers = []
+_condition = threading.Condition()
+_counters = collections.Counter()
+
+
+def start_workers(count=WEBHOOK_WORKERS):
+    """Start the worker pool. Safe to call more than once."""
+    with _condition:
+        while len(_workers) < count:
+            worker = threading.Thread(target=_worker_loop, name=f'webhook-worker-{len(_workers)}', daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+
+def submit(func, *args, lane=None, **kwargs):
+    """Queue `func(*args, **kwargs)` for a worker, in the lane of the caller unless given. Return False if full."""
+    global _unfinished
+
+    if not _workers:
+        start_workers()
+
+    lane = lane or current_lane()
+    with _condition:
+        jobs = _jobs[lane]
+        if len(jobs) >= WEBHOOK_QUEUE_SIZE:
+            _counters['rejected'] += 1
+            full = True
+        else:
+            jobs.append((func, args, kwargs))
+            _unfinished += 1
+            _counters['submitted'] += 1
+            full = False
+            _condition.notify_all()
+
+    if full:
+        log.warning(f'Work queue is full ({WEBHOOK_QUEUE_SIZE} {lane} jobs), rejecting '
+                    f'{getattr(func, "__name__", func)}')
+        return False
+    return True
+
+
+def join(timeout=None):
+    """Wait until the queued jobs are done. Return False if they are not done within the timeout."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _condition:
+        while _unfinished:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            _condition.wait(remaining)
+    return True
+
+
+def queue_stats():
+    """Return a snapshot of the queue depth (per lane as well) and job counters."""
+    with _condition:
+        stats = dict(_counters)
+        stats['workers'] = len(_workers)
+        stats['busy'] = sum(_busy.values())
+        stats['depth'] = sum(len(jobs) for jobs in _jobs.values())
+        for lane, jobs in _jobs.items():
+            stats[f'depth_{lane}'] = len(jobs)
+
+    stats['capacity'] = WEBHOOK_QUEUE_SIZE
+    return stats
+
+
+def _next_lane():
+    """Return the most urgent lane with a job a free worker may take, or None."""
+    for lane in LANES:
+        if not _jobs[lane]:
+            continue
+        if lane == INTERACTIVE:
+            return lane
+
+        # Reruns and background jobs leave the reserved workers to interactive jobs.
+        if sum(_busy.values()) - _busy[INTERACTIVE] >= max(len(_workers) - WEBHOOK_RESERVED_WORKERS, 1):
+            return None
+        if lane != BACKGROUND or _busy[BACKGROUND] < WEBHOOK_BACKGROUND_WORKERS:
+            return lane
+    return None
+
+
+def _worker_loop():
+    global _unfinished
+
+    while True:
+        with _condition:
+            lane = _next_lane()
+            while lane is None:
+                _condition.wait()
+                lane = _next_lane()
+            func, args, kwargs = _jobs[lane].popleft()
+            _busy[lane] += 1
+
+        succeeded = False
+        try:
+            with in_lane(lane):
+                func(*args, **kwargs)
+            succeeded = True
+        except Exception:
+            log.error(f'Queued {lane} job {getattr(func, "__name__", func)} failed.')
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            with _condition:
+                _busy[lane] -= 1
+                _unfinished -= 1
+                _counters['processed' if succeeded else 'failed'] += 1
+                # A worker may now take a job of a lane that was at its limit.
+                _condition.notify_all()
+
+
+def _reset_after_fork():
+    # The worker threads don't survive a fork, the child starts its own.
+    _workers.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
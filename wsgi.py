@@ -0,0 +1,13 @@
+from app import app, drain, start, warm_up
+
+"""
+WSGI ENTRY POINT
+=================
+The app for production WSGI servers, warmed up on import:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+warm_up()
+
+__all__ = ['app', 'drain', 'start']